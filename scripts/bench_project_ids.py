@@ -0,0 +1,79 @@
+"""Benchmarks the ProjectId codec and checks generated ids for collisions
+across threads and processes.
+
+Run from the repository root:
+
+    python -m scripts.bench_project_ids
+"""
+import multiprocessing
+import sys
+import threading
+import timeit
+from typing import List
+
+from server.classes import ProjectId
+
+REPEAT = 5
+NUMBER = 10
+CODEC_SAMPLE = 10000
+THREADS = 8
+PROCESSES = 4
+IDS_PER_WORKER = 20000
+
+
+def bench(label: str, stmt: str, namespace: dict) -> None:
+    timer = timeit.Timer(stmt, globals=namespace)
+    best = min(timer.repeat(repeat=REPEAT, number=NUMBER)) / NUMBER
+    print('{:<28} {:>10.3f} ms'.format(label, best * 1000))
+
+
+def generate_many(count: int) -> List[int]:
+    return [int(ProjectId.generate()) for _ in range(count)]
+
+
+def check_threads() -> bool:
+    results: List[List[int]] = [[] for _ in range(THREADS)]
+
+    def work(i: int) -> None:
+        results[i] = generate_many(IDS_PER_WORKER)
+
+    threads = [threading.Thread(target=work, args=(i, ))
+               for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [x for result in results for x in result]
+    unique = len(set(ids))
+    print('threads: ' + str(len(ids)) + ' ids, ' + str(unique) + ' unique')
+    return unique == len(ids)
+
+
+def check_processes() -> bool:
+    with multiprocessing.Pool(PROCESSES) as pool:
+        results = pool.map(generate_many, [IDS_PER_WORKER] * PROCESSES)
+
+    ids = [x for result in results for x in result]
+    unique = len(set(ids))
+    print('processes: ' + str(len(ids)) + ' ids, ' + str(unique) + ' unique')
+    return unique == len(ids)
+
+
+def main() -> None:
+    ids = [ProjectId.generate() for _ in range(CODEC_SAMPLE)]
+    strings = [str(x) for x in ids]
+    namespace = {'ids': ids, 'strings': strings, 'ProjectId': ProjectId}
+
+    print('codec: ' + str(CODEC_SAMPLE) + ' ids')
+    bench('to string', '[str(x) for x in ids]', namespace)
+    bench('from string', '[ProjectId.from_string(x) for x in strings]',
+          namespace)
+
+    ok = check_threads() and check_processes()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
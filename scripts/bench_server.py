@@ -0,0 +1,225 @@
+"""Benchmarks the web tier against an in-process fake of S3.
+
+Builds a synthetic package catalog and set of revisions, imports the Flask
+app against them and measures throughput and latency percentiles for the
+main API routes through Flask's test client. Results are printed as JSON so
+runs from different commits can be compared.
+
+Run from the repository root:
+
+    python -m scripts.bench_server --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from scripts import fake_s3
+
+BUCKET = 'ellie-bench'
+
+ENVIRONMENT = {
+    'AWS_S3_BUCKET': BUCKET,
+    'COOKIE_SECRET': 'bench-cookie-secret',
+    'ENV': 'development',
+    'GTM_ID': 'GTM-BENCH',
+    'CDN_BASE': 'http://localhost:8000',
+    'SERVER_HOSTNAME': 'http://localhost:5000',
+    'PACKAGE_SYNC_INTERVAL_MINUTES': '60',
+    # Every request comes from one client, which the limits would throttle.
+    'ADMISSION_CONTROL_ENABLED': '0'
+}
+
+ELM_CODE = '''module Main exposing (main)
+
+import Html exposing (Html, text)
+
+
+main : Html msg
+main =
+    text "Hello, World!"
+'''
+
+
+def make_catalog(rng: random.Random, package_count: int,
+                 versions_per_package: int) -> List[Dict[str, Any]]:
+    names = [('elm-lang', 'core'), ('elm-lang', 'html')] + [
+        ('user' + str(i % (package_count // 5 + 1)), 'package-' + str(i))
+        for i in range(package_count - 2)
+    ]
+    output = []
+    for username, package in names:
+        for i in range(versions_per_package):
+            output.append({
+                'username': username,
+                'package': package,
+                'version': str(i // 3 + 1) + '.' + str(i % 3) + '.0',
+                'elmVersion': rng.choice([
+                    '0.18.0 <= v < 0.19.0', '0.18.0 <= v < 0.19.0',
+                    '0.17.0 <= v < 0.18.0'
+                ])
+            })
+    return output
+
+
+def make_revision(project_id: str, revision_number: int) -> Dict[str, Any]:
+    return {
+        'title': 'Revision ' + str(revision_number) + ' of ' + project_id,
+        'description': 'A synthetic revision for benchmarking',
+        'elmCode': ELM_CODE * 20,
+        'htmlCode': '<html><body></body></html>',
+        'packages': [['elm-lang/core', '5.1.1'], ['elm-lang/html', '2.0.0']],
+        'id': {'projectId': project_id, 'revisionNumber': revision_number},
+        'snapshot': {'tag': 'NotSaved'},
+        'elmVersion': '0.18.0',
+        'acceptedTerms': 1
+    }
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def run_scenario(count: int, request: Callable[[int], Any]) -> Dict[str, Any]:
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(count):
+        before = time.perf_counter()
+        response = request(i)
+        latencies.append(time.perf_counter() - before)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': count / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def git_commit() -> Any:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=3000)
+    parser.add_argument('--versions-per-package', type=int, default=4)
+    parser.add_argument('--revisions', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated seconds per S3 call')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    repo_root = os.getcwd()
+    commit = git_commit()
+    work_dir = tempfile.mkdtemp(prefix='ellie-bench-server-')
+    os.makedirs(os.path.join(work_dir, 'build'))
+    with open(os.path.join(work_dir, 'build', 'manifest.json'), 'w') as f:
+        f.write('{}')
+
+    store = fake_s3.FakeStore(latency=args.latency)
+    catalog = make_catalog(rng, args.packages, args.versions_per_package)
+    store.put(BUCKET, 'package-artifacts/searchable.json',
+              json.dumps(catalog), 'application/json')
+
+    from server.classes import ProjectId
+    revisions = []
+    for i in range(args.revisions):
+        project_id = str(ProjectId.generate())
+        revisions.append(project_id)
+        store.put(BUCKET, 'revisions/' + project_id + '/0.json',
+                  json.dumps(make_revision(project_id, 0)),
+                  'application/json')
+
+    fake_s3.install(store)
+    os.environ.update(ENVIRONMENT)
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_root)
+    try:
+        started = time.perf_counter()
+        from server.server import app
+        cold_start = time.perf_counter() - started
+
+        client = app.test_client()
+        names = [(e['username'], e['package']) for e in catalog]
+        queries = ['core', 'html', 'user1', 'package-1', 'elm-lang/',
+                   '/package', 'pack', 'us']
+        count = args.requests
+
+        scenarios: Dict[str, Callable[[int], Any]] = {
+            'search': lambda i: client.get(
+                '/api/search?elmVersion=0.18.0&query=' +
+                queries[i % len(queries)]),
+            'versions': lambda i: client.get(
+                '/api/packages/%s/%s/versions' % rng.choice(names)),
+            'default_revision': lambda i: client.get(
+                '/api/revisions/default'),
+            'revision': lambda i: client.get(
+                '/api/revisions/' + rng.choice(revisions) + '/0'),
+            'upload_urls': lambda i: client.get('/api/upload'),
+            'oembed': lambda i: client.get(
+                '/oembed?url=https://ellie-app.com/' +
+                rng.choice(revisions) + '/0')
+        }
+
+        elm_format = os.path.join(repo_root, 'node_modules', '.bin',
+                                  'elm-format')
+        if os.path.exists(elm_format):
+            scenarios['format'] = lambda i: client.post(
+                '/api/format', data=json.dumps({'source': ELM_CODE}),
+                content_type='application/json')
+
+        results = {
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'catalog': {
+                'package_versions': len(catalog),
+                'revisions': len(revisions)
+            },
+            'simulated_s3_latency_seconds': args.latency,
+            'cold_start_seconds': cold_start,
+            'scenarios': {},
+            's3_calls': {}
+        }
+        # Keep stray prints from request handlers out of the JSON output.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, request in scenarios.items():
+                results['scenarios'][name] = run_scenario(count, request)
+        results['s3_calls'] = dict(store.calls)
+    finally:
+        os.chdir(repo_root)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Benchmarks and profiles the package sync pipeline offline.
+
+Feeds `sync_packages.process_package` from a local corpus of package zips
+laid out as `<user>/<package>/<version>.zip` (GitHub archive layout inside),
+through a fake HTTP source and the in-process S3 fake. Reports time spent in
+each stage, CPU utilization across the joblib workers and peak memory as
+JSON. With --profile-dir, packages slower than --profile-threshold get a
+cProfile (or pyinstrument) dump.
+
+Run from the repository root:
+
+    python -m scripts.bench_sync --synthetic 200
+    python -m scripts.bench_sync --corpus ~/elm-packages --profile-dir prof
+"""
+import argparse
+import cProfile
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Any, Dict, List, Optional
+
+from scripts import fake_s3
+
+BUCKET = 'ellie-bench'
+
+ENVIRONMENT = {
+    'AWS_S3_BUCKET': BUCKET,
+    'COOKIE_SECRET': 'bench-cookie-secret',
+    'ENV': 'development',
+    'PACKAGE_SYNC_INTERVAL_MINUTES': '60'
+}
+
+STAGES = ['download', 'unzip', 'read_sources', 'elm_make', 'upload']
+
+
+class FakeResponse(object):
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def iter_content(self, chunk_size: int = 1) -> Any:
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, 'rb') as file_data:
+            while True:
+                chunk = file_data.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self) -> None:
+        pass
+
+
+class FakeHttpSource(object):
+    """Serves github.com archive URLs out of the local corpus."""
+
+    def __init__(self, corpus: str) -> None:
+        self._corpus = corpus
+
+    def get(self, url: str, **kwargs: Any) -> FakeResponse:
+        # http://github.com/<user>/<package>/archive/<version>.zip
+        parts = url.split('/')
+        return FakeResponse(
+            os.path.join(self._corpus, parts[3], parts[4], parts[6]))
+
+
+def make_synthetic_corpus(directory: str, count: int,
+                          files_per_package: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for i in range(count):
+        username = 'user' + str(i % 20)
+        package = 'package-' + str(i)
+        version = str(rng.randint(1, 5)) + '.0.' + str(rng.randint(0, 9))
+        package_dir = os.path.join(directory, username, package)
+        os.makedirs(package_dir, exist_ok=True)
+        root = package + '-' + version + '/'
+        with zipfile.ZipFile(os.path.join(package_dir, version + '.zip'),
+                             'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(root + 'elm-package.json', json.dumps({
+                'version': version,
+                'summary': 'synthetic package',
+                'repository': 'https://github.com/' + username + '/' +
+                              package + '.git',
+                'license': 'BSD3',
+                'source-directories': ['src'],
+                'exposed-modules': [],
+                'dependencies': {
+                    'elm-lang/core': '5.0.0 <= v < 6.0.0'
+                },
+                'elm-version': '0.18.0 <= v < 0.19.0'
+            }))
+            for j in range(rng.randint(1, files_per_package)):
+                body = '\n'.join(
+                    'value' + str(k) + ' = ' + str(k)
+                    for k in range(rng.randint(50, 2000)))
+                archive.writestr(
+                    root + 'src/Module' + str(j) + '.elm',
+                    'module Module' + str(j) + ' exposing (..)\n\n' + body)
+
+
+def read_corpus(directory: str) -> List[Any]:
+    from server.classes import PackageInfo, Version
+    output = []
+    for username in sorted(os.listdir(directory)):
+        for package in sorted(os.listdir(os.path.join(directory, username))):
+            for filename in sorted(
+                    os.listdir(os.path.join(directory, username, package))):
+                version = Version.from_string(filename[:-len('.zip')])
+                if filename.endswith('.zip') and version is not None:
+                    output.append(PackageInfo(username, package, version))
+    return output
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_package(package: Any, profile_dir: Optional[str],
+                    profile_threshold: float,
+                    profiler: str) -> Dict[str, Any]:
+    from server import sync_packages
+
+    timings: Dict[str, float] = {}
+    profile: Any = None
+    if profile_dir is not None:
+        if profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profile = Profiler()
+            profile.start()
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+
+    cpu_started = time.process_time() + _children_cpu()
+    started = time.perf_counter()
+    succeeded, _, _ = sync_packages.process_package(package, timings)
+    wall = time.perf_counter() - started
+    cpu = time.process_time() + _children_cpu() - cpu_started
+
+    profile_path = None
+    if profile is not None:
+        name = package.username + '-' + package.package + '-' + \
+            str(package.version)
+        if profiler == 'pyinstrument':
+            profile.stop()
+            if wall >= profile_threshold:
+                profile_path = os.path.join(profile_dir, name + '.html')
+                with open(profile_path, 'w') as f:
+                    f.write(profile.output_html())
+        else:
+            profile.disable()
+            if wall >= profile_threshold:
+                profile_path = os.path.join(profile_dir, name + '.prof')
+                profile.dump_stats(profile_path)
+
+    return {
+        'package': str(package),
+        'succeeded': succeeded,
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'stages': timings,
+        'pid': os.getpid(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_max_rss_kb':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'profile': profile_path
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--corpus', help='directory of package zips')
+    source.add_argument('--synthetic', type=int,
+                        help='generate a corpus of this many packages')
+    parser.add_argument('--files-per-package', type=int, default=20)
+    parser.add_argument('--jobs', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--profile-dir')
+    parser.add_argument('--profile-threshold', type=float, default=0.0,
+                        help='only keep profiles of packages slower than '
+                        'this many seconds')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'],
+                        default='cprofile')
+    parser.add_argument('--outliers', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    repo_root = os.getcwd()
+    temp_dir = tempfile.mkdtemp(prefix='ellie-bench-sync-')
+    if args.corpus is not None:
+        corpus = os.path.abspath(args.corpus)
+    else:
+        corpus = os.path.join(temp_dir, 'corpus')
+        make_synthetic_corpus(corpus, args.synthetic,
+                              args.files_per_package, args.seed)
+    if args.profile_dir is not None:
+        os.makedirs(args.profile_dir, exist_ok=True)
+        args.profile_dir = os.path.abspath(args.profile_dir)
+
+    store = fake_s3.FakeStore()
+    store.put(BUCKET, 'package-artifacts/searchable.json', json.dumps([
+        {'username': 'elm-lang', 'package': 'core', 'version': '5.1.1',
+         'elmVersion': '0.18.0 <= v < 0.19.0'},
+        {'username': 'elm-lang', 'package': 'html', 'version': '2.0.0',
+         'elmVersion': '0.18.0 <= v < 0.19.0'}
+    ]))
+    fake_s3.install(store)
+    os.environ.update(ENVIRONMENT)
+    os.chdir(temp_dir)
+    sys.path.insert(0, repo_root)
+
+    try:
+        from joblib import Parallel, delayed
+        from server import sync_packages
+        sync_packages.requests = FakeHttpSource(corpus)  # type: ignore
+
+        packages = read_corpus(corpus)
+        # Mirrors sync_packages.run, which waits for each group of
+        # `jobs` packages before starting the next.
+        groups = [packages[x:x + args.jobs]
+                  for x in range(0, len(packages), args.jobs)]
+        results: List[Dict[str, Any]] = []
+        started = time.perf_counter()
+        for group in groups:
+            results.extend(Parallel(n_jobs=args.jobs)(
+                delayed(measure_package)(p, args.profile_dir,
+                                         args.profile_threshold,
+                                         args.profiler)
+                for p in group))
+        wall = time.perf_counter() - started
+    finally:
+        os.chdir(repo_root)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    cpu = sum(r['cpu_seconds'] for r in results)
+    stage_totals = {
+        stage: sum(r['stages'].get(stage, 0.0) for r in results)
+        for stage in STAGES
+    }
+    slowest = sorted(results, key=lambda r: r['wall_seconds'],
+                     reverse=True)[:args.outliers]
+    report = {
+        'packages': len(results),
+        'succeeded': sum(1 for r in results if r['succeeded']),
+        'jobs': args.jobs,
+        'wall_seconds': wall,
+        'packages_per_second': len(results) / wall if wall else 0.0,
+        'cpu_seconds': cpu,
+        'cpu_utilization': cpu / (wall * args.jobs) if wall else 0.0,
+        'stage_seconds': stage_totals,
+        'peak_worker_rss_kb': max(
+            [r['max_rss_kb'] for r in results] or [0]),
+        'peak_elm_make_rss_kb': max(
+            [r['children_max_rss_kb'] for r in results] or [0]),
+        'slowest': slowest
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Microbenchmark for the Version/Constraint primitives.
+
+Run from the repository root:
+
+    python -m scripts.bench_versions
+"""
+import random
+import timeit
+from typing import List
+
+from server.classes import (Constraint, PackageInfo, Version,
+                            filter_by_elm_version)
+
+CORPUS_SIZE = 10000
+REPEAT = 5
+NUMBER = 10
+
+ELM_VERSIONS = [
+    Version(0, 18, 0),
+    Version(0, 17, 1),
+    Version(0, 17, 0),
+    Version(0, 16, 0),
+    Version(0, 15, 0)
+]
+
+ELM_CONSTRAINTS = [
+    Constraint.from_string('0.18.0 <= v < 0.19.0'),
+    Constraint.from_string('0.17.0 <= v < 0.18.0'),
+    Constraint.from_string('0.16.0 <= v < 0.17.0'),
+    Constraint.from_string('0.15.0 <= v < 0.16.0'),
+    Constraint.from_string('0.14.0 <= v <= 0.15.1')
+]
+
+
+def make_corpus(size: int) -> List[PackageInfo]:
+    rng = random.Random(1234)
+    output = []
+    package_count = size // 10
+    for i in range(size):
+        version = Version(
+            rng.randint(0, 5), rng.randint(0, 12), rng.randint(0, 9))
+        info = PackageInfo('user' + str(i % (package_count // 4)),
+                           'package' + str(i % package_count), version)
+        info.set_elm_constraint(rng.choice(ELM_CONSTRAINTS))
+        output.append(info)
+    return output
+
+
+def bench(label: str, stmt: str, namespace: dict) -> None:
+    timer = timeit.Timer(stmt, globals=namespace)
+    best = min(timer.repeat(repeat=REPEAT, number=NUMBER)) / NUMBER
+    print('{:<28} {:>10.3f} ms'.format(label, best * 1000))
+
+
+def main() -> None:
+    corpus = make_corpus(CORPUS_SIZE)
+    versions = [p.version for p in corpus]
+    namespace = {
+        'corpus': corpus,
+        'versions': versions,
+        'elm_versions': ELM_VERSIONS,
+        'filter_by_elm_version': filter_by_elm_version
+    }
+
+    print('corpus: ' + str(CORPUS_SIZE) + ' package versions')
+    bench('sort versions', 'sorted(versions)', namespace)
+    bench('hash versions', 'set(versions)', namespace)
+    bench('is_satisfied x elm versions',
+          '[p for v in elm_versions for p in corpus '
+          'if p.elm_constraint.is_satisfied(v)]', namespace)
+    bench('filter_by_elm_version',
+          '[filter_by_elm_version(corpus, v) for v in elm_versions]',
+          namespace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Rewrites saved revisions in the delta format read by `storage.get_revision`.
+
+For each project, every --keyframe-interval-th revision is kept as a full
+document and the others are replaced, under the same key, by a delta
+against the keyframe before them. A revision is only rewritten when the
+delta is smaller than the document it replaces, and already-compacted
+revisions are skipped, so the tool can be rerun safely.
+
+    python -m scripts.compact_revisions --jobs 16
+    python -m scripts.compact_revisions --project <project id> --dry-run
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple
+
+import boto3
+
+from server import revision_deltas, revision_encoding
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+
+client = boto3.client('s3')
+
+
+def list_projects() -> Iterator[str]:
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix='revisions/',
+                                   Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            yield prefix['Prefix'][len('revisions/'):-1]
+
+
+def list_revision_numbers(project_id: str) -> List[int]:
+    paginator = client.get_paginator('list_objects_v2')
+    output = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME,
+                                   Prefix='revisions/' + project_id + '/'):
+        for item in page.get('Contents', []):
+            name = item['Key'].rsplit('/', 1)[1]
+            if name.endswith('.json') and name[:-len('.json')].isdigit():
+                output.append(int(name[:-len('.json')]))
+    return sorted(output)
+
+
+def read_revision(project_id: str,
+                  revision_number: int) -> Tuple[Any, int, bool]:
+    response = client.get_object(
+        Bucket=BUCKET_NAME,
+        Key='revisions/' + project_id + '/' + str(revision_number) + '.json')
+    size = response['ContentLength']
+    gzipped = revision_encoding.is_gzip(response)
+    return json.loads(revision_encoding.read_body(response)), size, gzipped
+
+
+def compact_project(project_id: str, interval: int,
+                    dry_run: bool) -> Dict[str, int]:
+    stats = {'revisions': 0, 'compacted': 0, 'bytes_before': 0,
+             'bytes_after': 0}
+    keyframes: Dict[int, Any] = {}
+    for revision_number in list_revision_numbers(project_id):
+        stats['revisions'] += 1
+        data, size, gzipped = read_revision(project_id, revision_number)
+        stats['bytes_before'] += size
+        base_number = revision_deltas.keyframe_for(revision_number, interval)
+        if revision_number == base_number or revision_deltas.is_delta(data):
+            if revision_number == base_number:
+                keyframes[revision_number] = data
+            stats['bytes_after'] += size
+            continue
+
+        base = keyframes.get(base_number)
+        if base is None or revision_deltas.is_delta(base):
+            stats['bytes_after'] += size
+            continue
+
+        delta = json.dumps(revision_deltas.encode(base_number, base, data),
+                           separators=(',', ':')).encode('utf-8')
+        extra_args = {}
+        if gzipped:
+            delta = revision_encoding.encode(delta)
+            extra_args['ContentEncoding'] = revision_encoding.GZIP
+        if len(delta) >= size:
+            stats['bytes_after'] += size
+            continue
+
+        stats['compacted'] += 1
+        stats['bytes_after'] += len(delta)
+        if not dry_run:
+            client.put_object(
+                Bucket=BUCKET_NAME,
+                Key='revisions/' + project_id + '/' + str(revision_number) +
+                '.json',
+                ACL='public-read',
+                Body=delta,
+                ContentType='application/json',
+                **extra_args)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', action='append',
+                        help='only compact this project id (repeatable)')
+    parser.add_argument('--keyframe-interval', type=int,
+                        default=revision_deltas.KEYFRAME_INTERVAL)
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    projects = args.project if args.project else list_projects()
+    totals = {'projects': 0, 'revisions': 0, 'compacted': 0,
+              'bytes_before': 0, 'bytes_after': 0}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for stats in executor.map(
+                lambda p: compact_project(p, args.keyframe_interval,
+                                          args.dry_run), projects):
+            totals['projects'] += 1
+            for key, value in stats.items():
+                totals[key] += value
+            if totals['projects'] % 100 == 0:
+                print('compact_revisions: ' + str(totals['projects']) +
+                      ' projects')
+
+    print(json.dumps(totals, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
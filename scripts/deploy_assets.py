@@ -1,23 +1,111 @@
+"""Uploads the built assets in build/manifest.json to S3.
+
+File names are content-hashed, so anything already in the bucket is
+skipped and everything is uploaded with an immutable Cache-Control. Each
+asset is also stored gzip- and, when the `brotli` module is installed,
+brotli-compressed next to the original. The variants that exist are
+written to build/compressed-manifest.json for `assets.asset_path`.
+"""
+import gzip
 import json
-import boto3
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
 
-with open('./build/manifest.json') as file_data:
-    manifest = json.load(file_data)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+JOBS = int(os.environ.get('DEPLOY_ASSETS_JOBS', '8'))
+
+# Compressed copies that are not at least this much smaller than the
+# original are not worth a separate object.
+MIN_SAVING = 0.9
 
 client = boto3.client('s3')
 
-for key, value in manifest.items():
-    print('deploying ' + key)
-    client.upload_file(
-        './build/' + value,
-        os.environ['AWS_S3_BUCKET'],
-        'assets/' + value,
-        ExtraArgs={
-            'ACL':
-            'public-read',
-            'ContentType':
-            'text/css' if key.endswith('.css') else 'application/javascript'
-        })
-
-print('asset deploy complete')
+
+def content_type(key: str) -> str:
+    return 'text/css' if key.endswith('.css') else 'application/javascript'
+
+
+def exists(key: str) -> bool:
+    try:
+        client.head_object(Bucket=BUCKET_NAME, Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+def upload(key: str, body: bytes, manifest_key: str,
+           encoding: Optional[str] = None) -> bool:
+    if exists(key):
+        return False
+
+    extra = {
+        'ACL': 'public-read',
+        'Body': body,
+        'ContentType': content_type(manifest_key),
+        'CacheControl': CACHE_CONTROL
+    }
+    if encoding is not None:
+        extra['ContentEncoding'] = encoding
+    client.put_object(Bucket=BUCKET_NAME, Key=key, **extra)
+    return True
+
+
+def compressed_variants(data: bytes) -> List[Tuple[str, str, bytes]]:
+    output = [('gzip', '.gz', gzip.compress(data, compresslevel=9))]
+    if brotli is not None:
+        output.append(('br', '.br', brotli.compress(data)))
+    return [v for v in output if len(v[2]) <= len(data) * MIN_SAVING]
+
+
+def deploy(item: Tuple[str, str]) -> Tuple[str, List[str], int]:
+    manifest_key, filename = item
+    with open('./build/' + filename, 'rb') as file_data:
+        data = file_data.read()
+
+    uploaded = 0
+    if upload('assets/' + filename, data, manifest_key):
+        uploaded += 1
+
+    encodings = []
+    for encoding, suffix, body in compressed_variants(data):
+        if upload('assets/' + filename + suffix, body, manifest_key,
+                  encoding):
+            uploaded += 1
+        encodings.append(encoding)
+    return filename, encodings, uploaded
+
+
+def main() -> None:
+    with open('./build/manifest.json') as file_data:
+        manifest = json.load(file_data)
+
+    if brotli is None:
+        print('brotli is not installed, skipping brotli variants')
+
+    compressed: Dict[str, List[str]] = {}
+    uploaded = 0
+    with ThreadPoolExecutor(max_workers=JOBS) as executor:
+        for filename, encodings, count in executor.map(
+                deploy, sorted(manifest.items())):
+            print(('deployed ' if count else 'unchanged ') + filename)
+            compressed[filename] = encodings
+            uploaded += count
+
+    with open('./build/compressed-manifest.json', 'w') as file_data:
+        json.dump(compressed, file_data, indent=2, sort_keys=True)
+
+    print('asset deploy complete, ' + str(uploaded) + ' objects uploaded')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""An in-process stand-in for the parts of boto3's S3 API the server uses.
+
+`install` patches `boto3.client` and `boto3.resource`, so it has to run
+before any `server` module is imported.
+"""
+import hashlib
+import io
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class StoredObject(NamedTuple):
+    body: bytes
+    content_type: Optional[str]
+    content_encoding: Optional[str]
+    metadata: Dict[str, str]
+
+
+class FakeBody(object):
+    def __init__(self, data: bytes) -> None:
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._stream.read() if amt is None else self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Any:
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+def _not_found(operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}},
+                       operation)
+
+
+class FakeStore(object):
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._objects: Dict[Tuple[str, str], StoredObject] = {}
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put(self, bucket: str, key: str, body: Any,
+            content_type: Optional[str] = None,
+            content_encoding: Optional[str] = None,
+            metadata: Optional[Dict[str, str]] = None) -> None:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            body = body.read()
+        with self._lock:
+            self._objects[(bucket, key)] = StoredObject(
+                body, content_type, content_encoding, metadata or {})
+
+    def get(self, bucket: str, key: str) -> StoredObject:
+        with self._lock:
+            stored = self._objects.get((bucket, key))
+        if stored is None:
+            raise _not_found('GetObject')
+        return stored
+
+    def delete(self, bucket: str, key: str) -> None:
+        with self._lock:
+            self._objects.pop((bucket, key), None)
+
+    def keys(self, bucket: str, prefix: str = '') -> Any:
+        with self._lock:
+            return sorted(k for b, k in self._objects
+                          if b == bucket and k.startswith(prefix))
+
+
+def _get_response(stored: StoredObject) -> Dict[str, Any]:
+    response: Dict[str, Any] = {
+        'Body': FakeBody(stored.body),
+        'ContentLength': len(stored.body),
+        'ETag': '"' + hashlib.md5(stored.body).hexdigest() + '"',
+        'Metadata': dict(stored.metadata)
+    }
+    if stored.content_type is not None:
+        response['ContentType'] = stored.content_type
+    if stored.content_encoding is not None:
+        response['ContentEncoding'] = stored.content_encoding
+    return response
+
+
+class FakePaginator(object):
+    """Serves list_objects_v2 as a single page."""
+
+    def __init__(self, store: FakeStore) -> None:
+        self._store = store
+
+    def paginate(self, Bucket: str, Prefix: str = '',
+                 Delimiter: Optional[str] = None, **kwargs: Any) -> Any:
+        self._store._call('list_objects_v2')
+        contents = []
+        prefixes: List[str] = []
+        for key in self._store.keys(Bucket, Prefix):
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common = Prefix + rest[:rest.index(Delimiter) + 1]
+                if common not in prefixes:
+                    prefixes.append(common)
+            else:
+                contents.append({
+                    'Key': key,
+                    'Size': len(self._store.get(Bucket, key).body)
+                })
+        page: Dict[str, Any] = {'Contents': contents}
+        if Delimiter is not None:
+            page['CommonPrefixes'] = [{'Prefix': p} for p in prefixes]
+        return [page]
+
+
+class FakeClient(object):
+    def __init__(self, store: FakeStore) -> None:
+        self._store = store
+
+    def get_object(self, Bucket: str, Key: str, **kwargs: Any) -> Any:
+        self._store._call('get_object')
+        return _get_response(self._store.get(Bucket, Key))
+
+    def head_object(self, Bucket: str, Key: str, **kwargs: Any) -> Any:
+        self._store._call('head_object')
+        response = _get_response(self._store.get(Bucket, Key))
+        del response['Body']
+        return response
+
+    def put_object(self, Bucket: str, Key: str, Body: Any = b'',
+                   ContentType: Optional[str] = None,
+                   ContentEncoding: Optional[str] = None,
+                   Metadata: Optional[Dict[str, str]] = None,
+                   **kwargs: Any) -> Any:
+        self._store._call('put_object')
+        self._store.put(Bucket, Key, Body, ContentType, ContentEncoding,
+                        Metadata)
+        return {}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs: Any) -> Any:
+        self._store._call('delete_object')
+        self._store.delete(Bucket, Key)
+        return {}
+
+    def upload_fileobj(self, Fileobj: Any, Bucket: str, Key: str,
+                       ExtraArgs: Optional[Dict[str, Any]] = None,
+                       **kwargs: Any) -> None:
+        self._store._call('upload_fileobj')
+        extra = ExtraArgs or {}
+        self._store.put(Bucket, Key, Fileobj.read(), extra.get('ContentType'),
+                        extra.get('ContentEncoding'), extra.get('Metadata'))
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str,
+                    ExtraArgs: Optional[Dict[str, Any]] = None,
+                    **kwargs: Any) -> None:
+        with open(Filename, 'rb') as file_data:
+            self.upload_fileobj(file_data, Bucket, Key, ExtraArgs)
+
+    def get_paginator(self, operation: str) -> FakePaginator:
+        assert operation == 'list_objects_v2'
+        return FakePaginator(self._store)
+
+    def download_file(self, Bucket: str, Key: str, Filename: str,
+                      **kwargs: Any) -> None:
+        self._store._call('download_file')
+        stored = self._store.get(Bucket, Key)
+        with open(Filename, 'wb') as file_data:
+            file_data.write(stored.body)
+
+    def generate_presigned_post(self, Bucket: str, Key: str,
+                                Fields: Optional[Dict[str, Any]] = None,
+                                Conditions: Any = None,
+                                **kwargs: Any) -> Any:
+        self._store._call('generate_presigned_post')
+        fields = dict(Fields or {})
+        fields['key'] = Key
+        fields['policy'] = 'fake-policy'
+        fields['x-amz-signature'] = 'fake-signature'
+        return {'url': 'https://' + Bucket + '.s3.amazonaws.com/',
+                'fields': fields}
+
+
+class FakeObject(object):
+    def __init__(self, store: FakeStore, bucket: str, key: str) -> None:
+        self._store = store
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self, **kwargs: Any) -> Any:
+        self._store._call('get_object')
+        return _get_response(self._store.get(self.bucket_name, self.key))
+
+    def put(self, Body: Any = b'', ContentType: Optional[str] = None,
+            ContentEncoding: Optional[str] = None,
+            Metadata: Optional[Dict[str, str]] = None,
+            **kwargs: Any) -> Any:
+        self._store._call('put_object')
+        self._store.put(self.bucket_name, self.key, Body, ContentType,
+                        ContentEncoding, Metadata)
+        return {}
+
+
+class FakeBucket(object):
+    def __init__(self, store: FakeStore, name: str) -> None:
+        self._store = store
+        self.name = name
+
+    def put_object(self, Key: str, Body: Any = b'',
+                   ContentType: Optional[str] = None,
+                   ContentEncoding: Optional[str] = None,
+                   Metadata: Optional[Dict[str, str]] = None,
+                   **kwargs: Any) -> Any:
+        self._store._call('put_object')
+        self._store.put(self.name, Key, Body, ContentType, ContentEncoding,
+                        Metadata)
+        return FakeObject(self._store, self.name, Key)
+
+    def upload_fileobj(self, Fileobj: Any, Key: str,
+                       ExtraArgs: Optional[Dict[str, Any]] = None,
+                       **kwargs: Any) -> None:
+        FakeClient(self._store).upload_fileobj(Fileobj, self.name, Key,
+                                               ExtraArgs)
+
+
+class FakeResource(object):
+    def __init__(self, store: FakeStore) -> None:
+        self._store = store
+
+    def Object(self, bucket: str, key: str) -> FakeObject:
+        return FakeObject(self._store, bucket, key)
+
+    def Bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self._store, name)
+
+
+def install(store: FakeStore) -> None:
+    boto3.client = lambda *args, **kwargs: FakeClient(store)  # type: ignore
+    boto3.resource = \
+        lambda *args, **kwargs: FakeResource(store)  # type: ignore
@@ -0,0 +1,78 @@
+"""Re-encodes stored revisions with gzip.
+
+Each `revisions/<id>/<n>.json` object that is not already gzip-encoded is
+compressed and written back under the same key with
+`Content-Encoding: gzip`. Objects are processed in parallel, and the tool
+can be rerun safely since encoded objects are skipped.
+
+    python -m scripts.gzip_revisions --jobs 32
+    python -m scripts.gzip_revisions --prefix revisions/<project id>/ --dry-run
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator
+
+import boto3
+
+from server import revision_encoding
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+
+client = boto3.client('s3')
+
+
+def list_revision_keys(prefix: str) -> Iterator[str]:
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].endswith('.json'):
+                yield item['Key']
+
+
+def gzip_revision(key: str, dry_run: bool) -> Dict[str, int]:
+    response = client.get_object(Bucket=BUCKET_NAME, Key=key)
+    if revision_encoding.is_gzip(response):
+        response['Body'].close()
+        return {'skipped': 1, 'encoded': 0, 'bytes_before': 0,
+                'bytes_after': 0}
+
+    raw = revision_encoding.read_body(response)
+    encoded = revision_encoding.encode(raw)
+    if not dry_run:
+        client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=key,
+            ACL='public-read',
+            Body=encoded,
+            ContentType='application/json',
+            ContentEncoding=revision_encoding.GZIP,
+            Metadata=response.get('Metadata', {}))
+    return {'skipped': 0, 'encoded': 1, 'bytes_before': len(raw),
+            'bytes_after': len(encoded)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prefix', default='revisions/')
+    parser.add_argument('--jobs', type=int, default=16)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    totals = {'skipped': 0, 'encoded': 0, 'bytes_before': 0,
+              'bytes_after': 0}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for i, stats in enumerate(executor.map(
+                lambda key: gzip_revision(key, args.dry_run),
+                list_revision_keys(args.prefix))):
+            for key, value in stats.items():
+                totals[key] += value
+            if (i + 1) % 1000 == 0:
+                print('gzip_revisions: ' + str(i + 1) + ' objects')
+
+    print(json.dumps(totals, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
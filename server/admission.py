@@ -0,0 +1,197 @@
+"""Admission control for the expensive API routes.
+
+Each route class has a limit on requests in flight across the worker, a
+limit on requests in flight per client, and a per-client token bucket.
+Requests over a limit are turned away at once instead of queueing: 503
+when the worker is saturated, 429 when one client is over its share, both
+with Retry-After.
+
+Limits are configured per host, but state is kept per gunicorn worker
+process: each of the WEB_CONCURRENCY workers enforces its share of every
+limit, rounded up to at least one request. A client whose requests are
+spread over several workers can therefore get somewhat more than its
+limit in flight, never less.
+
+Limits can be tuned with ADMISSION_<CLASS>_<SETTING> environment
+variables, e.g. ADMISSION_FORMAT_CONCURRENCY=8; a RATE of 0 turns off the
+token bucket for that class. Admission control can be turned off with
+ADMISSION_CONTROL_ENABLED=0. Rejections and in-flight counts are exported
+through `metrics`.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict, NamedTuple
+
+from flask import request
+
+from . import metrics
+from .classes import ApiError
+
+ENABLED = os.environ.get('ADMISSION_CONTROL_ENABLED', '1') == '1'
+
+# gunicorn reads the same variable for its number of workers.
+WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+
+# Token buckets are kept for this many recently seen clients per class.
+MAX_TRACKED_CLIENTS = 10000
+
+REJECTED = 'ellie_admission_rejected_total'
+IN_FLIGHT = 'ellie_admission_in_flight'
+
+
+def _setting(class_name: str, setting: str, default: float) -> float:
+    return float(os.environ.get(
+        'ADMISSION_' + class_name.upper() + '_' + setting, default))
+
+
+def _share(host_limit: float) -> int:
+    return max(1, int(math.ceil(host_limit / WORKERS)))
+
+
+class RouteClass(NamedTuple):
+    name: str
+    concurrency: int
+    client_concurrency: int
+    # Sustained requests per second per client, and how many may come at
+    # once after a quiet period.
+    rate: float
+    burst: float
+
+    @staticmethod
+    def from_env(name: str, concurrency: int, client_concurrency: int,
+                 rate: float, burst: float) -> 'RouteClass':
+        """Takes per-host limits and returns this worker's share."""
+        return RouteClass(
+            name,
+            _share(_setting(name, 'CONCURRENCY', concurrency)),
+            _share(_setting(name, 'CLIENT_CONCURRENCY', client_concurrency)),
+            max(0.0, _setting(name, 'RATE', rate)) / WORKERS,
+            float(_share(_setting(name, 'BURST', burst))))
+
+
+class _ClientState(object):
+    __slots__ = ('tokens', 'updated', 'in_flight')
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+        self.in_flight = 0
+
+
+class Limiter(object):
+    def __init__(self, route_class: RouteClass) -> None:
+        self.route_class = route_class
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._clients: 'OrderedDict[str, _ClientState]' = OrderedDict()
+
+    def _client(self, client: str, now: float) -> _ClientState:
+        state = self._clients.get(client)
+        if state is None:
+            state = self._clients[client] = _ClientState(
+                self.route_class.burst, now)
+            while len(self._clients) > MAX_TRACKED_CLIENTS:
+                oldest, oldest_state = next(iter(self._clients.items()))
+                if oldest_state.in_flight:
+                    break
+                del self._clients[oldest]
+        else:
+            self._clients.move_to_end(client)
+        return state
+
+    def enter(self, client: str) -> None:
+        route_class = self.route_class
+        now = time.monotonic()
+        with self._lock:
+            if self.in_flight >= route_class.concurrency:
+                self._reject('concurrency')
+                raise ApiError(503, 'the server is busy, try again shortly',
+                               retry_after=1)
+
+            state = self._client(client, now)
+            if state.in_flight >= route_class.client_concurrency:
+                self._reject('client_concurrency')
+                raise ApiError(429, 'too many requests in progress',
+                               retry_after=1)
+
+            if route_class.rate > 0:
+                state.tokens = min(
+                    route_class.burst,
+                    state.tokens + (now - state.updated) * route_class.rate)
+                state.updated = now
+                if state.tokens < 1:
+                    self._reject('rate')
+                    raise ApiError(429, 'too many requests',
+                                   retry_after=int(math.ceil(
+                                       (1 - state.tokens) / route_class.rate)))
+                state.tokens -= 1
+
+            state.in_flight += 1
+            self.in_flight += 1
+
+    def exit(self, client: str) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            state = self._clients.get(client)
+            if state is not None:
+                state.in_flight -= 1
+
+    def _reject(self, reason: str) -> None:
+        metrics.increment(REJECTED, (('class', self.route_class.name),
+                                     ('reason', reason)))
+
+
+_limiters: Dict[str, Limiter] = {
+    c.name: Limiter(c) for c in [
+        # Each request runs an elm-format subprocess.
+        RouteClass.from_env('format', 4, 1, 1.0, 5),
+        # Each request may run elm-make.
+        RouteClass.from_env('compile', 4, 1, 0.2, 3),
+        # Several S3 calls per request.
+        RouteClass.from_env('upload', 16, 2, 2.0, 10),
+        RouteClass.from_env('resolve', 8, 2, 2.0, 10)
+    ]
+}
+
+
+def _in_flight() -> Dict[metrics.Labels, float]:
+    return {
+        (('class', name), ): float(limiter.in_flight)
+        for name, limiter in _limiters.items()
+    }
+
+
+metrics.describe(REJECTED, 'Requests turned away, by route class and limit.')
+metrics.gauge(IN_FLIGHT, 'Admitted requests in progress, by route class.',
+              _in_flight)
+
+
+def client_address() -> str:
+    # The Heroku router appends the address it saw to X-Forwarded-For, so
+    # the last entry is the one a client cannot forge.
+    route = request.access_route
+    return route[-1] if route else (request.remote_addr or '')
+
+
+def limit(class_name: str) -> Callable[[Callable[..., Any]],
+                                       Callable[..., Any]]:
+    limiter = _limiters[class_name]
+
+    def decorator(view: Callable[..., Any]) -> Callable[..., Any]:
+        if not ENABLED:
+            return view
+
+        @wraps(view)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            client = client_address()
+            limiter.enter(client)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.exit(client)
+        return wrapper
+    return decorator
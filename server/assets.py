@@ -1,5 +1,6 @@
 import json
 import os
+from typing import Any, Dict, List
 
 import boto3
 
@@ -9,20 +10,43 @@ _PRODUCTION = os.environ['ENV'] != 'development'
 with open('./build/manifest.json') as file_data:
     _manifest = json.load(file_data)
 
+# Written by scripts/deploy_assets.py: the compressed copies stored next to
+# each asset, keyed by its hashed file name.
+_compressed: Dict[str, List[str]] = {}
+if os.path.exists('./build/compressed-manifest.json'):
+    with open('./build/compressed-manifest.json') as file_data:
+        _compressed = json.load(file_data)
 
-def _prod_asset_path(relative: str) -> str:
-    if relative in _manifest:
-        return _CDN_BASE + '/assets/' + _manifest[relative]
-    else:
+# Most preferred first.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _prod_asset_path(relative: str, accept_encodings: Any) -> str:
+    if relative not in _manifest:
         return ''
 
+    filename = _manifest[relative]
+    if accept_encodings is not None:
+        available = _compressed.get(filename, [])
+        for encoding, suffix in ENCODINGS:
+            if encoding in available and encoding in accept_encodings:
+                return _CDN_BASE + '/assets/' + filename + suffix
+    return _CDN_BASE + '/assets/' + filename
+
 
 def _dev_asset_path(relative: str) -> str:
     return 'http://localhost:8000/' + relative
 
 
-def asset_path(relative: str) -> str:
+def has_compressed_variants() -> bool:
+    return _PRODUCTION and bool(_compressed)
+
+
+def asset_path(relative: str, accept_encodings: Any = None) -> str:
+    """The URL of a built asset. Given the request's Accept-Encoding, it
+    points at a precompressed copy the client can decode, if one was
+    deployed."""
     if _PRODUCTION:
-        return _prod_asset_path(relative)
+        return _prod_asset_path(relative, accept_encodings)
     else:
         return _dev_asset_path(relative)
@@ -0,0 +1,396 @@
+"""The package catalog: one download and parse of searchable.json per
+snapshot, from which both the versions JSON served by the API and the Whoosh
+search index are built.
+
+Each snapshot is built once per host, by whichever worker takes the build
+lock first, into its own directory under CATALOG_DIR:
+
+    <snapshot>/catalog.bin      rendered JSON, memory-mapped by every worker
+    <snapshot>/index/           Whoosh index shared by all compiler versions
+    <snapshot>/dependencies.json
+                                the dependency graph, loaded on first use
+    <snapshot>/in-use.lock      share-locked by every worker using it
+
+The directory is written under a temporary name and renamed into place, so
+workers never see a half-written snapshot, and nothing in it is modified
+afterwards. Old snapshots are only deleted once no worker holds their
+in-use lock.
+
+catalog.bin layout (little-endian):
+
+    header          MAGIC, FORMAT_VERSION, entry count
+    default entry   the default revision JSON
+    entries         one per package, sorted by "user/project"
+    blob            names and JSON bodies the entries point into
+
+Each entry is (name offset, name length, body offset, body length, etag).
+
+Compiler versions are identified by their bit in `all_versions`: each
+package version carries a mask of the compilers it works with, and each
+search document lists the bits for which it is the latest release, so
+supporting a new Elm release adds a bit rather than another index.
+"""
+import fcntl
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+from hashlib import sha1
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Tuple
+
+import boto3
+import whoosh.analysis as analysis
+import whoosh.fields as fields
+import whoosh.index as index
+from botocore.exceptions import ClientError
+
+from . import constants, metrics, package_watcher
+from .classes import (Package, PackageInfoTable, PackageName, RenderedJson,
+                      Version, intern_package, intern_package_name)
+from .resolver import DependencyGraph
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+CATALOG_DIR = os.environ.get('PACKAGE_CATALOG_DIR', '.packages_catalog')
+SEARCHABLE_KEY = 'package-artifacts/searchable.json'
+DEPENDENCIES_KEY = 'package-artifacts/dependencies.json'
+
+MAGIC = b'ELMCATLG'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sII')
+ENTRY = struct.Struct('<IIII40s')
+
+# Snapshots older than this many are deleted after a build, unless a worker
+# that has not refreshed yet is still using them.
+KEEP_SNAPSHOTS = 2
+
+s3 = boto3.resource('s3')
+client = boto3.client('s3')
+
+# Append new compiler versions; a version's position is its bit.
+all_versions = [
+    Version(0, 18, 0),
+    Version(0, 17, 1),
+    Version(0, 17, 0),
+    Version(0, 16, 0),
+    Version(0, 15, 0)
+]
+
+_elm_version_bits = {v: bit for bit, v in enumerate(all_versions)}
+
+_analyzer = analysis.NgramWordAnalyzer(
+    2,
+    maxsize=None,
+    tokenizer=analysis.RegexTokenizer(
+        expression=re.compile("[/-]"), gaps=True)
+)
+
+schema = fields.Schema(
+    username=fields.TEXT(analyzer=_analyzer, phrase=False, field_boost=1.5),
+    package=fields.TEXT(analyzer=_analyzer, phrase=False),
+    full_name=fields.TEXT(analyzer=_analyzer, phrase=False),
+    full_package=fields.STORED,
+    elm_versions=fields.KEYWORD
+)
+
+
+class SearchablePackages(NamedTuple):
+    latest_by_elm_version: Dict[Version, Package]
+    versions: List[Version]
+
+
+def download_searchable_packages() -> Tuple[str, PackageInfoTable]:
+    with metrics.dependency('searchable_json'):
+        response = s3.Object(BUCKET_NAME, SEARCHABLE_KEY).get()
+        body = response['Body']
+        data = body.read()
+        body.close()
+    return response['ETag'], PackageInfoTable.from_json(json.loads(data))
+
+
+def download_dependency_graph(path: str) -> None:
+    try:
+        with metrics.dependency('dependencies_json'):
+            client.download_file(BUCKET_NAME, DEPENDENCIES_KEY, path)
+    except ClientError:
+        # Not written by a sync yet; resolution finds nothing until it is.
+        pass
+
+
+def organize_packages(
+        packages: PackageInfoTable) -> Dict[PackageName, SearchablePackages]:
+    data: Dict[PackageName, SearchablePackages] = {}
+    latest: Dict[Tuple[PackageName, int], int] = {}
+    masks = packages.elm_version_masks(all_versions)
+    for username, package, version, mask in zip(packages.usernames,
+                                                packages.packages,
+                                                packages.versions, masks):
+        key = intern_package_name(username, package)
+        if key not in data:
+            data[key] = SearchablePackages({}, [])
+        data[key].versions.append(Version.from_int(version))
+
+        bit = 0
+        while mask:
+            if mask & 1 and latest.get((key, bit), -1) < version:
+                latest[(key, bit)] = version
+            mask >>= 1
+            bit += 1
+
+    for (key, bit), version in latest.items():
+        data[key].latest_by_elm_version[all_versions[bit]] = intern_package(
+            key, Version.from_int(version))
+    return data
+
+
+def render_versions(data: Dict[PackageName, SearchablePackages]
+                    ) -> Dict[PackageName, RenderedJson]:
+    return {
+        key: RenderedJson.render([v.to_json() for v in value.versions])
+        for key, value in data.items()
+    }
+
+
+def render_default_revision(
+        data: Dict[PackageName, SearchablePackages]) -> RenderedJson:
+    elm_version = Version(0, 18, 0)
+    default_html = data[intern_package_name(
+        'elm-lang', 'html')].latest_by_elm_version[elm_version]
+    default_core = data[intern_package_name(
+        'elm-lang', 'core')].latest_by_elm_version[elm_version]
+
+    return RenderedJson.render({
+        'packages': [default_core.to_json(), default_html.to_json()],
+        'elmVersion': elm_version.to_json(),
+        'title': '',
+        'description': '',
+        'id': None,
+        'elmCode': constants.DEFAULT_ELM_CODE,
+        'htmlCode': constants.DEFAULT_HTML_CODE
+    })
+
+
+def build_index(data: Dict[PackageName, SearchablePackages],
+                directory: str) -> None:
+    with metrics.dependency('whoosh_index_build'):
+        os.makedirs(directory)
+        idx = index.create_in(directory, schema)
+        writer = idx.writer()
+
+        for name, value in data.items():
+            # One document per distinct latest release, tagged with the
+            # compiler versions it is the latest release for.
+            bits: Dict[Package, List[str]] = {}
+            for elm_version, latest in value.latest_by_elm_version.items():
+                bits.setdefault(latest, []).append(
+                    str(_elm_version_bits[elm_version]))
+
+            for latest, elm_versions in bits.items():
+                writer.add_document(
+                    username=name.user,
+                    package=name.project,
+                    full_name=str(name),
+                    full_package=latest,
+                    elm_versions=' '.join(elm_versions)
+                )
+
+        writer.commit()
+
+
+def write_catalog_file(data: Dict[PackageName, SearchablePackages],
+                       path: str) -> None:
+    versions_json = render_versions(data)
+    default_revision = render_default_revision(data)
+    names = sorted((str(name).encode('utf-8'), name) for name in data)
+
+    blob = bytearray()
+    blob_start = HEADER.size + ENTRY.size * (len(names) + 1)
+
+    def entry(name: bytes, rendered: RenderedJson) -> bytes:
+        name_offset = blob_start + len(blob)
+        blob.extend(name)
+        body_offset = blob_start + len(blob)
+        blob.extend(rendered.body)
+        return ENTRY.pack(name_offset, len(name), body_offset,
+                          len(rendered.body), rendered.etag.encode('ascii'))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(names)))
+        f.write(entry(b'', default_revision))
+        for encoded, name in names:
+            f.write(entry(encoded, versions_json[name]))
+        f.write(blob)
+
+
+class CatalogFile(object):
+    """A read-only view of catalog.bin. The file is mapped rather than
+    read, so every worker on the host shares the same pages."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('unsupported package catalog file: ' + path)
+
+    def _entry(self, i: int) -> Tuple[int, int, int, int, bytes]:
+        name_offset, name_length, body_offset, body_length, etag = \
+            ENTRY.unpack_from(self._map, HEADER.size + ENTRY.size * i)
+        return name_offset, name_length, body_offset, body_length, etag
+
+    def _rendered(self, i: int) -> RenderedJson:
+        _, _, body_offset, body_length, etag = self._entry(i)
+        return RenderedJson(self._map[body_offset:body_offset + body_length],
+                            etag.decode('ascii'))
+
+    def default_revision_json(self) -> RenderedJson:
+        return self._rendered(0)
+
+    def versions_json(self, full_name: str) -> Optional[RenderedJson]:
+        key = full_name.encode('utf-8')
+        low, high = 1, self._count + 1
+        while low < high:
+            middle = (low + high) // 2
+            name_offset, name_length, _, _, _ = self._entry(middle)
+            name = self._map[name_offset:name_offset + name_length]
+            if name == key:
+                return self._rendered(middle)
+            elif name < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+
+def _snapshot_name(etag: str) -> str:
+    return 'v' + str(FORMAT_VERSION) + '-' + \
+        sha1(etag.encode('utf-8')).hexdigest()[:16]
+
+
+def _remove_old_snapshots(keep: str) -> None:
+    snapshots = sorted(
+        (os.path.join(CATALOG_DIR, name) for name in os.listdir(CATALOG_DIR)
+         if name.startswith('v')),
+        key=os.path.getmtime, reverse=True)
+    for path in snapshots[KEEP_SNAPSHOTS:]:
+        if os.path.basename(path) == keep:
+            continue
+        with open(os.path.join(path, 'in-use.lock'), 'a') as in_use:
+            try:
+                fcntl.flock(in_use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _build_snapshot() -> str:
+    etag, packages = download_searchable_packages()
+    name = _snapshot_name(etag)
+    path = os.path.join(CATALOG_DIR, name)
+    if os.path.exists(path):
+        return path
+
+    temp_path = tempfile.mkdtemp(prefix='build-', dir=CATALOG_DIR)
+    try:
+        data = organize_packages(packages)
+        write_catalog_file(data, os.path.join(temp_path, 'catalog.bin'))
+        build_index(data, os.path.join(temp_path, 'index'))
+        download_dependency_graph(
+            os.path.join(temp_path, 'dependencies.json'))
+        open(os.path.join(temp_path, 'in-use.lock'), 'w').close()
+        os.chmod(temp_path, 0o755)
+        os.rename(temp_path, path)
+    except:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+    _remove_old_snapshots(name)
+    return path
+
+
+def _use_snapshot(path: str) -> IO[str]:
+    """Share-locks the snapshot so no other worker deletes it. The lock is
+    held until the returned file is closed or garbage collected."""
+    in_use = open(os.path.join(path, 'in-use.lock'), 'a')
+    fcntl.flock(in_use, fcntl.LOCK_SH)
+    return in_use
+
+
+def ensure_snapshot() -> Tuple[str, IO[str]]:
+    """Returns the directory of the snapshot matching the current
+    searchable.json, building it if no worker on this host has yet, and
+    its in-use lock."""
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    with open(os.path.join(CATALOG_DIR, 'build.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with metrics.dependency('s3_head_object'):
+                etag = client.head_object(Bucket=BUCKET_NAME,
+                                          Key=SEARCHABLE_KEY)['ETag']
+            path = os.path.join(CATALOG_DIR, _snapshot_name(etag))
+            if not os.path.exists(path):
+                path = _build_snapshot()
+            # Taken under the build lock, since old snapshots are only
+            # deleted while it is held.
+            return path, _use_snapshot(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class Catalog(NamedTuple):
+    path: str
+    file: CatalogFile
+    index: Any
+    in_use: IO[str]
+
+
+def open_catalog() -> Catalog:
+    path, in_use = ensure_snapshot()
+    return Catalog(path,
+                   CatalogFile(os.path.join(path, 'catalog.bin')),
+                   index.open_dir(os.path.join(path, 'index')), in_use)
+
+
+_catalog: Catalog = open_catalog()
+_graph: Optional[Tuple[str, DependencyGraph]] = None
+_graph_lock = threading.Lock()
+
+
+def refresh() -> None:
+    global _catalog
+    # Only called from the watcher thread. Opened off to the side and
+    # swapped in with a single assignment, so requests always see either
+    # the old snapshot or the new one.
+    _catalog = open_catalog()
+
+
+package_watcher.subscribe(refresh)
+
+
+def get_versions_json(user: str, project: str) -> Optional[RenderedJson]:
+    return _catalog.file.versions_json(user + '/' + project)
+
+
+def get_default_revision_json() -> RenderedJson:
+    return _catalog.file.default_revision_json()
+
+
+def get_search_index() -> Any:
+    return _catalog.index
+
+
+def elm_version_bit(elm_version: Version) -> Optional[int]:
+    return _elm_version_bits.get(elm_version)
+
+
+def get_dependency_graph() -> DependencyGraph:
+    global _graph
+    catalog = _catalog
+    with _graph_lock:
+        if _graph is None or _graph[0] != catalog.path:
+            _graph = (catalog.path, DependencyGraph.load(
+                os.path.join(catalog.path, 'dependencies.json')))
+        return _graph[1]
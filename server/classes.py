@@ -1,9 +1,16 @@
+import fcntl
+import json
 import os
 import random
+import sys
+import tempfile
+import threading
 import time
+from array import array
+from hashlib import sha1
 from math import floor
-from typing import (Any, Dict, Iterator, List, NamedTuple, Optional,
-                    SupportsInt, TypeVar)
+from typing import (IO, Any, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, SupportsInt, Tuple, TypeVar)
 
 T = TypeVar('T')
 
@@ -17,37 +24,85 @@ def cat_optionals(data: Iterator[Optional[T]]) -> List[T]:
 
 
 class ApiError(Exception):
-    def __init__(self, status_code: int, message: str) -> None:
+    def __init__(self, status_code: int, message: str,
+                 retry_after: Optional[int] = None) -> None:
         self.status_code = status_code
         self.message = message
+        self.retry_after = retry_after
+
+
+class RenderedJsonBase(NamedTuple):
+    body: bytes
+    etag: str
+
+
+class RenderedJson(RenderedJsonBase):
+    """A serialized JSON response body with a strong ETag over its bytes."""
+
+    @staticmethod
+    def render(data: Any) -> 'RenderedJson':
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        return RenderedJson(body=body, etag=sha1(body).hexdigest())
+
+
+def _parse_version_parts(input: Any) -> Optional[Tuple[int, int, int]]:
+    try:
+        major, minor, patch = input.split('.')
+        return (int(major), int(minor), int(patch))
+    except (AttributeError, ValueError):
+        return None
 
 
 class Version(SupportsInt):
+    __slots__ = ('major', 'minor', 'patch', '_value')
+    major: int
+    minor: int
+    patch: int
+    _value: int
+
     def __init__(self, major: int, minor: int, patch: int) -> None:
-        self.major = major
-        self.minor = minor
-        self.patch = patch
+        object.__setattr__(self, 'major', major)
+        object.__setattr__(self, 'minor', minor)
+        object.__setattr__(self, 'patch', patch)
+        object.__setattr__(self, '_value',
+                           (major << 20) | (minor << 10) | patch)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('Version is immutable')
+
+    def __reduce__(self) -> Any:
+        return (Version, (self.major, self.minor, self.patch))
 
     def __hash__(self) -> int:
-        return hash(self.__int__())
+        return hash(self._value)
 
     def __lt__(self, other: object) -> bool:
         if not isinstance(other, Version):
             return NotImplemented
-        return self.__int__() < int(other)
+        return self._value < other._value
 
     def __le__(self, other: object) -> bool:
         if not isinstance(other, Version):
             return NotImplemented
-        return self.__int__() <= int(other)
+        return self._value <= other._value
+
+    def __gt__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._value > other._value
+
+    def __ge__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._value >= other._value
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Version):
             return NotImplemented
-        return self.__int__() == int(other)
+        return self._value == other._value
 
     def __int__(self) -> int:
-        return (self.major << 20) | (self.minor << 10) | self.patch
+        return self._value
 
     def __str__(self) -> str:
         return str(self.major) + '.' + str(self.minor) + '.' + str(self.patch)
@@ -71,15 +126,10 @@ class Version(SupportsInt):
 
     @staticmethod
     def from_string(input: str) -> Optional['Version']:
-        try:
-            split = input.split('.')
-            as_ints = list(map(int, split))
-            all_worked = all(isinstance(x, int) for x in as_ints)
-            if all_worked and len(as_ints) == 3:
-                return Version(as_ints[0], as_ints[1], as_ints[2])
-            return None
-        except:
+        parts = _parse_version_parts(input)
+        if parts is None:
             return None
+        return Version(parts[0], parts[1], parts[2])
 
     @staticmethod
     def from_json(data: Any) -> Optional['Version']:
@@ -87,15 +137,36 @@ class Version(SupportsInt):
 
 
 class Constraint(object):
+    __slots__ = ('lower', 'lower_op', 'upper_op', 'upper', '_min', '_max')
+    lower: Version
+    lower_op: str
+    upper_op: str
+    upper: Version
+    _min: int
+    _max: int
+
     def __init__(self,
                  lower: Version,
                  lower_op: str,
                  upper_op: str,
                  upper: Version) -> None:
-        self.lower = lower
-        self.lower_op = lower_op
-        self.upper_op = upper_op
-        self.upper = upper
+        object.__setattr__(self, 'lower', lower)
+        object.__setattr__(self, 'lower_op', lower_op)
+        object.__setattr__(self, 'upper_op', upper_op)
+        object.__setattr__(self, 'upper', upper)
+        # Bounds are stored as packed ints, half-open: _min <= v < _max.
+        # Adding 1 to a packed version is the same as taking its next patch.
+        object.__setattr__(self, '_min', int(lower) + 1
+                           if lower_op == '<' else int(lower))
+        object.__setattr__(self, '_max', int(upper)
+                           if upper_op == '<' else int(upper) + 1)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('Constraint is immutable')
+
+    def __reduce__(self) -> Any:
+        return (Constraint,
+                (self.lower, self.lower_op, self.upper_op, self.upper))
 
     def __str__(self) -> str:
         return str(self.lower
@@ -108,11 +179,13 @@ class Constraint(object):
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Constraint):
             return False
-        return self.min_version() == other.min_version() and self.max_version(
-        ) == other.max_version()
+        return self._min == other._min and self._max == other._max
+
+    def __hash__(self) -> int:
+        return hash((self._min, self._max))
 
     def is_satisfied(self, version: Version) -> bool:
-        return self.min_version() <= version < self.max_version()
+        return self._min <= version._value < self._max
 
     def min_version(self) -> Version:
         if self.lower_op == '<':
@@ -132,13 +205,13 @@ class Constraint(object):
     @staticmethod
     def from_string(input: str) -> Optional['Constraint']:
         split = input.split('v')
+        if len(split) != 2:
+            return None
+
         trimmed = list(map(lambda x: x.strip(' '), split))
         left_stuff = trimmed[0]
         right_stuff = trimmed[1]
 
-        if left_stuff is None or right_stuff is None:
-            return None
-
         left_op = '<=' if left_stuff.endswith('<=') else '<'
         left_version = Version.from_string(left_stuff.rstrip(left_op + ' '))
         right_op = '<=' if right_stuff.startswith('<=') else '<'
@@ -160,26 +233,44 @@ class Constraint(object):
 
 
 class PackageName(object):
+    __slots__ = ('user', 'project', '_full_name', '_hash')
+    user: str
+    project: str
+    _full_name: str
+    _hash: int
+
     def __init__(self, user: str, project: str) -> None:
-        self.user = user
-        self.project = project
+        full_name = user + '/' + project
+        object.__setattr__(self, 'user', user)
+        object.__setattr__(self, 'project', project)
+        object.__setattr__(self, '_full_name', full_name)
+        object.__setattr__(self, '_hash', hash(full_name))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('PackageName is immutable')
+
+    def __reduce__(self) -> Any:
+        return (intern_package_name, (self.user, self.project))
 
     def __str__(self) -> str:
-        return self.user + '/' + self.project
+        return self._full_name
 
     def __repr__(self) -> str:
-        return '<PackageName ' + self.__str__() + '>'
+        return '<PackageName ' + self._full_name + '>'
 
     def __hash__(self) -> int:
-        return hash(self.__str__())
+        return self._hash
 
     def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
         if not isinstance(other, PackageName):
             return NotImplemented
-        return self.user == other.user and self.project == other.project
+        return self._hash == other._hash and \
+            self._full_name == other._full_name
 
     def to_json(self) -> object:
-        return self.__str__()
+        return self._full_name
 
     @staticmethod
     def from_json(data: Any) -> Optional['PackageName']:
@@ -190,15 +281,49 @@ class PackageName(object):
         return PackageName(split[0], split[1])
 
 
+_package_names: Dict[Tuple[str, str], PackageName] = {}
+
+
+def intern_package_name(user: str, project: str) -> PackageName:
+    key = (user, project)
+    name = _package_names.get(key)
+    if name is None:
+        name = _package_names.setdefault(
+            key, PackageName(sys.intern(user), sys.intern(project)))
+    return name
+
+
 class Package(object):
+    __slots__ = ('name', 'version', '_hash')
+    name: 'PackageName'
+    version: Version
+    _hash: int
+
     def __init__(self, name: 'PackageName', version: Version) -> None:
-        self.name = name
-        self.version = version
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, '_hash', hash((name._hash, version._value)))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('Package is immutable')
+
+    def __reduce__(self) -> Any:
+        return (intern_package, (self.name, self.version))
 
     def __repr__(self) -> str:
         return '<Package ' + self.name.user + '/' + \
             self.name.project + '@' + str(self.version) + '>'
 
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, Package):
+            return NotImplemented
+        return self.name == other.name and self.version == other.version
+
     def to_json(self) -> object:
         return [self.name.to_json(), self.version.to_json()]
 
@@ -215,12 +340,38 @@ class Package(object):
         return Package(name, version)
 
 
+_packages: Dict[Tuple[PackageName, int], Package] = {}
+
+
+def intern_package(name: PackageName, version: Version) -> Package:
+    key = (name, version._value)
+    package = _packages.get(key)
+    if package is None:
+        package = _packages.setdefault(
+            key,
+            Package(intern_package_name(name.user, name.project), version))
+    return package
+
+
 class PackageInfo(object):
+    __slots__ = ('username', 'package', 'version', 'elm_constraint', '_hash')
+
     def __init__(self, username: str, package: str, version: Version) -> None:
         self.username = username
         self.package = package
         self.version = version
         self.elm_constraint: Optional[Constraint] = None
+        self._hash = hash((username, package, version._value))
+
+    def __getstate__(self) -> Any:
+        # String hashes differ between processes, so _hash is recomputed
+        # rather than pickled.
+        return (self.username, self.package, self.version,
+                self.elm_constraint)
+
+    def __setstate__(self, state: Any) -> None:
+        self.__init__(state[0], state[1], state[2])  # type: ignore
+        self.elm_constraint = state[3]
 
     def __str__(self) -> str:
         return self.username + '/' + self.package + '@' + str(self.version)
@@ -231,7 +382,8 @@ class PackageInfo(object):
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, PackageInfo):
             return False
-        return self.username == other.username and \
+        return self._hash == other._hash and \
+            self.username == other.username and \
             self.package == other.package and \
             self.version == other.version
 
@@ -239,7 +391,7 @@ class PackageInfo(object):
         return not self.__eq__(other)
 
     def __hash__(self) -> int:
-        return hash(self.__str__())
+        return self._hash
 
     def s3_package_key(self) -> str:
         return 'package-artifacts/' + self.username + '/' + self.package + '/' + str(self.version) + '/elm-package.json'
@@ -262,7 +414,8 @@ class PackageInfo(object):
         }
 
     def to_package(self) -> Package:
-        return Package(PackageName(self.username, self.package), self.version)
+        return intern_package(
+            intern_package_name(self.username, self.package), self.version)
 
     @staticmethod
     def from_json(data: Dict[str, Any]) -> Optional['PackageInfo']:
@@ -281,15 +434,200 @@ class PackageInfo(object):
         return package
 
 
+def filter_by_elm_version(packages: Iterable[PackageInfo],
+                          elm_version: Version) -> List[PackageInfo]:
+    value = elm_version._value
+    return [
+        p for p in packages if p.elm_constraint is not None and
+        p.elm_constraint._min <= value < p.elm_constraint._max
+    ]
+
+
+class PackageInfoTable(object):
+    """Columnar form of a searchable.json package list.
+
+    Versions and elm version bounds are kept as packed ints in arrays, with
+    the bounds stored half-open and -1 marking a missing constraint.
+    `PackageInfo` objects are only built when a row is accessed. The parsed
+    constraints are kept too, shared between rows, so rows come back with
+    the constraint they were read with rather than its half-open form.
+    """
+
+    __slots__ = ('usernames', 'packages', 'versions', 'min_elm_versions',
+                 'max_elm_versions', 'elm_constraints')
+
+    def __init__(self) -> None:
+        self.usernames: List[str] = []
+        self.packages: List[str] = []
+        self.versions = array('q')
+        self.min_elm_versions = array('q')
+        self.max_elm_versions = array('q')
+        self.elm_constraints: List[Optional[Constraint]] = []
+
+    def __len__(self) -> int:
+        return len(self.versions)
+
+    def __getitem__(self, index: int) -> PackageInfo:
+        package = PackageInfo(self.usernames[index], self.packages[index],
+                              Version.from_int(self.versions[index]))
+        constraint = self.elm_constraints[index]
+        if constraint is None and self.min_elm_versions[index] >= 0:
+            constraint = Constraint.from_ints(self.min_elm_versions[index],
+                                              self.max_elm_versions[index])
+        if constraint is not None:
+            package.set_elm_constraint(constraint)
+        return package
+
+    def __iter__(self) -> Iterator[PackageInfo]:
+        for i in range(len(self.versions)):
+            yield self[i]
+
+    def elm_version_masks(self, elm_versions: List[Version]) -> List[int]:
+        """For each row, a bitmask with bit i set when the row works with
+        elm_versions[i]."""
+        values = [v._value for v in elm_versions]
+        masks: Dict[Tuple[int, int], int] = {}
+        output = []
+        for bounds in zip(self.min_elm_versions, self.max_elm_versions):
+            mask = masks.get(bounds)
+            if mask is None:
+                mask = 0
+                for bit, value in enumerate(values):
+                    if bounds[0] <= value < bounds[1]:
+                        mask |= 1 << bit
+                masks[bounds] = mask
+            output.append(mask)
+        return output
+
+    @staticmethod
+    def from_json(data: List[Dict[str, Any]]) -> 'PackageInfoTable':
+        table = PackageInfoTable()
+        constraints: Dict[Any, Optional[Constraint]] = {}
+        for entry in data:
+            version = _parse_version_parts(entry.get('version'))
+            if version is None:
+                continue
+
+            min_elm = -1
+            max_elm = -1
+            constraint = None
+            if 'minElmVersion' in entry and 'maxElmVersion' in entry:
+                min_elm = entry['minElmVersion']
+                max_elm = entry['maxElmVersion']
+            elif 'elmVersion' in entry:
+                # There are only a handful of distinct constraint strings.
+                if entry['elmVersion'] not in constraints:
+                    constraints[entry['elmVersion']] = Constraint.from_json(
+                        entry['elmVersion'])
+                constraint = constraints[entry['elmVersion']]
+                if constraint is not None:
+                    min_elm = constraint._min
+                    max_elm = constraint._max
+
+            table.usernames.append(sys.intern(entry['username']))
+            table.packages.append(sys.intern(entry['package']))
+            table.versions.append(
+                (version[0] << 20) | (version[1] << 10) | version[2])
+            table.min_elm_versions.append(min_elm)
+            table.max_elm_versions.append(max_elm)
+            table.elm_constraints.append(constraint)
+        return table
+
+
 def timestamp() -> int:
     return int(time.time() * 1000)
 
 
 ALPHABET = '23456789bcdfghjkmnpqrstvwxyzBCDFGHJKLMNPQRSTVWXYZ'
 BASE_LENGTH = len(ALPHABET)
-SEQ_ID = 0
-RELEASE_ID = int(os.environ.get('HEROKU_RELEASE_VERSION', '0').lstrip('v'))
-OUR_EPOCH = timestamp()
+ALPHABET_INDEX = {c: i for i, c in enumerate(ALPHABET)}
+
+# Generated ids are laid out as
+#
+#     (milliseconds since OUR_EPOCH) << 23 | worker id << 10 | sequence
+#
+# The epoch is fixed so ids from different processes share a time base. The
+# worker id is unique among live processes across the cluster: its high
+# DYNO_BITS are the dyno number from Heroku's DYNO variable (web.3 -> 3),
+# and its low SLOT_BITS are a slot claimed on the host by holding an flock
+# on WORKER_SLOTS_DIR/<slot>.lock for as long as the process lives.
+OUR_EPOCH = 1483228800000
+WORKER_ID_BITS = 13
+DYNO_BITS = 5
+SLOT_BITS = WORKER_ID_BITS - DYNO_BITS
+SEQ_ID_BITS = 10
+WORKER_SLOTS_DIR = os.environ.get(
+    'WORKER_SLOTS_DIR',
+    os.path.join(tempfile.gettempdir(), 'ellie-worker-slots'))
+
+
+def dyno_number(dyno: str) -> int:
+    _, _, number = dyno.rpartition('.')
+    if not number.isdigit():
+        return 0
+    if int(number) >= 1 << DYNO_BITS:
+        raise RuntimeError('dyno ' + dyno + ' does not fit in ' +
+                           str(DYNO_BITS) + ' bits of the project id')
+    return int(number)
+
+
+def _claim_slot(directory: str) -> Tuple[int, IO[str]]:
+    """Returns a slot no other live process on this host holds, and the
+    locked file that holds it."""
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(1 << SLOT_BITS):
+        f = open(os.path.join(directory, str(slot) + '.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        return slot, f
+    raise RuntimeError('no free project id worker slot in ' + directory)
+
+
+class _ProjectIdGenerator(object):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid = -1
+        self._worker_id = 0
+        self._slot_file: Optional[IO[str]] = None
+        self._last_millis = -1
+        self._seq_id = 0
+
+    def next(self) -> int:
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                # Claim a worker id of our own after a fork. The parent's
+                # slot file is left open; closing it here would release the
+                # parent's lock, which the fork shares.
+                self._pid = pid
+                slot, self._slot_file = _claim_slot(WORKER_SLOTS_DIR)
+                self._worker_id = (dyno_number(os.environ.get('DYNO', '')) <<
+                                   SLOT_BITS) | slot
+                self._last_millis = -1
+
+            now_millis = timestamp()
+            if now_millis < self._last_millis:
+                now_millis = self._last_millis
+            if now_millis == self._last_millis:
+                self._seq_id = (self._seq_id + 1) % (1 << SEQ_ID_BITS)
+                if self._seq_id == 0:
+                    while now_millis <= self._last_millis:
+                        time.sleep(0.0001)
+                        now_millis = timestamp()
+            else:
+                self._seq_id = 0
+            self._last_millis = now_millis
+
+            result = (now_millis - OUR_EPOCH) << (WORKER_ID_BITS + SEQ_ID_BITS)
+            result |= self._worker_id << SEQ_ID_BITS
+            result |= self._seq_id
+            return result
+
+
+_generator = _ProjectIdGenerator()
 
 
 class ProjectId(SupportsInt):
@@ -342,31 +680,25 @@ class ProjectId(SupportsInt):
 
     @staticmethod
     def generate() -> 'ProjectId':
-        global SEQ_ID
-        my_seq_id = (SEQ_ID + 1) % 1024
-        SEQ_ID += 1
-        now_millis = timestamp()
-        result = (now_millis - OUR_EPOCH) << 23
-        result |= RELEASE_ID << 10
-        result |= my_seq_id
-        return ProjectId(result, 1)
+        return ProjectId(_generator.next(), 1)
 
     @staticmethod
-    def _from_string_v0(input: str) -> 'ProjectId':
+    def _from_string_v0(input: str) -> Optional['ProjectId']:
         tracker = 0
-        length = len(input)
-        for i in range(length):
-            index = ALPHABET.index(input[i]) + 1
-            tracker = tracker * BASE_LENGTH + index
+        for char in input:
+            index = ALPHABET_INDEX.get(char)
+            if index is None:
+                return None
+            tracker = tracker * BASE_LENGTH + index + 1
         return ProjectId(tracker, 0)
 
     @staticmethod
-    def _from_string_v1(input: str) -> 'ProjectId':
+    def _from_string_v1(input: str) -> Optional['ProjectId']:
         tracker = 0
-        without_id = input.replace('a1', '')
-        length = len(without_id)
-        for i in range(length):
-            index = ALPHABET.index(without_id[i])
+        for char in input[:-2]:
+            index = ALPHABET_INDEX.get(char)
+            if index is None:
+                return None
             tracker = tracker * BASE_LENGTH + index
         return ProjectId(tracker, 1)
 
@@ -463,3 +795,18 @@ class Revision(RevisionBase):
             snapshot=data['snapshot'],
             elm_version=elm_version,
             accepted_terms=data.get('acceptedTerms'))
+
+
+class RevisionMetadataBase(NamedTuple):
+    title: str
+    description: str
+
+
+class RevisionMetadata(RevisionMetadataBase):
+    def to_json(self) -> Any:
+        return {'title': self.title, 'description': self.description}
+
+    @staticmethod
+    def from_json(data: Any) -> 'RevisionMetadata':
+        return RevisionMetadata(title=data['title'],
+                                description=data['description'])
@@ -1,16 +1,28 @@
 import os
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 
 from . import sync_packages
+from .sync_lock import LeaseLost, SyncLock
 
 SYNC_INTERVAL = int(os.environ['PACKAGE_SYNC_INTERVAL_MINUTES'])
-sched = BackgroundScheduler(daemon=False)
+sched = BlockingScheduler()
 
 
-@sched.scheduled_job('interval', minutes=SYNC_INTERVAL)
+@sched.scheduled_job('interval', minutes=SYNC_INTERVAL, max_instances=1,
+                     coalesce=True)
 def run_sync_packages() -> None:
-    sync_packages.run()
+    lock = SyncLock()
+    if not lock.acquire():
+        print('sync_packages: another runner holds the sync lock, skipping')
+        return
+
+    try:
+        sync_packages.run(lock)
+    except LeaseLost:
+        print('sync_packages: lost the sync lock, stopping')
+    finally:
+        lock.release()
 
 
 def start() -> None:
@@ -0,0 +1,279 @@
+"""Optional server-side compilation with the bundled elm-make.
+
+Off unless SERVER_COMPILE_ENABLED=1. At most COMPILE_WORKERS elm-make
+processes run at once per host, across all gunicorn workers: each one holds
+an flock on one of COMPILE_WORKERS slot files. A compile that cannot get a
+slot within SLOT_WAIT_SECONDS is turned away as busy. SLOT_WAIT_SECONDS
+plus COMPILE_TIMEOUT_SECONDS stays under gunicorn's 30 second worker
+timeout, so a slow compile fails with an error instead of the worker being
+killed.
+
+Results, including compiler errors, are stored in S3 under
+`compiled/<hash>.json`, where the hash covers the Elm code, the exact
+package set after resolving transitive dependencies, and the Elm version. Identical revisions are compiled once
+across the cluster and read back from there afterwards.
+
+Package sources and prebuilt artifacts come from the objects
+`sync_packages` uploads and are kept on local disk, one directory per
+package version, written under a temporary name and renamed into place.
+"""
+import base64
+import fcntl
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from . import catalog, metrics
+from .classes import ApiError, Constraint, Package, PackageInfo, Version
+
+ENABLED = os.environ.get('SERVER_COMPILE_ENABLED') == '1'
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+COMPILE_WORKERS = int(os.environ.get('COMPILE_WORKERS',
+                                     str(multiprocessing.cpu_count())))
+COMPILE_TIMEOUT_SECONDS = int(os.environ.get('COMPILE_TIMEOUT_SECONDS', '20'))
+SLOT_WAIT_SECONDS = 5
+SLOT_POLL_SECONDS = 0.1
+PACKAGES_DIR = os.path.join(tempfile.gettempdir(), 'ellie-compile-packages')
+SLOTS_DIR = os.path.join(tempfile.gettempdir(), 'ellie-compile-slots')
+
+# Package names are used as directory names, so only accept what the
+# package site does.
+PACKAGE_NAME_RE = re.compile(
+    r'^[A-Za-z0-9][A-Za-z0-9-]*/[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+# Only the compiler bundled in node_modules can be run here.
+SUPPORTED_ELM_VERSION = Version(0, 18, 0)
+
+ELM_MAKE_PATH = os.path.realpath(
+    os.path.dirname(os.path.realpath(__file__)) +
+    '/../node_modules/elm/Elm-Platform/0.18.0/.cabal-sandbox/bin/elm-make')
+
+client = boto3.client('s3')
+
+
+class CompileResult(NamedTuple):
+    js: Optional[str]
+    error: Optional[str]
+
+    def to_json(self) -> Any:
+        return {'js': self.js, 'error': self.error}
+
+    @staticmethod
+    def from_json(data: Any) -> 'CompileResult':
+        return CompileResult(data.get('js'), data.get('error'))
+
+
+def cache_key(elm_code: str, packages: List[Package],
+              elm_version: Version) -> str:
+    data = json.dumps([
+        elm_code,
+        sorted(p.to_json() for p in packages),
+        elm_version.to_json()
+    ], separators=(',', ':'))
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+def _read_cached(key: str) -> Optional[CompileResult]:
+    try:
+        with metrics.dependency('s3_get_object'):
+            body = client.get_object(
+                Bucket=BUCKET_NAME, Key='compiled/' + key + '.json')['Body']
+            data = json.loads(body.read())
+            body.close()
+        return CompileResult.from_json(data)
+    except ClientError:
+        return None
+
+
+def _write_cached(key: str, result: CompileResult) -> None:
+    with metrics.dependency('s3_put_object'):
+        client.put_object(
+            Bucket=BUCKET_NAME,
+            Key='compiled/' + key + '.json',
+            Body=json.dumps(result.to_json()).encode('utf-8'),
+            ContentType='application/json')
+
+
+def _download_json(key: str) -> Any:
+    try:
+        body = client.get_object(Bucket=BUCKET_NAME, Key=key)['Body']
+        data = json.loads(body.read())
+        body.close()
+        return data
+    except ClientError:
+        return None
+
+
+def _write_files(base_dir: str, files: Dict[str, str], binary: bool) -> None:
+    for name, contents in files.items():
+        path = os.path.join(base_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if binary and name.endswith('.elmi'):
+            with open(path, 'wb') as binary_file:
+                binary_file.write(base64.b64decode(contents))
+        else:
+            with open(path, 'w') as text_file:
+                text_file.write(contents)
+
+
+def _package_dir(package: Package) -> str:
+    """Returns a local directory holding the package's elm-package.json and
+    sources, plus its prebuilt artifacts under `artifacts/` if the sync
+    produced any."""
+    info = PackageInfo(package.name.user, package.name.project,
+                       package.version)
+    path = os.path.join(PACKAGES_DIR, str(package.name), str(package.version))
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = tempfile.mkdtemp(prefix='download-',
+                                 dir=os.path.dirname(path))
+    try:
+        with metrics.dependency('package_source'):
+            package_json = _download_json(info.s3_package_key())
+            sources = _download_json(info.s3_source_key())
+            artifacts = _download_json(
+                info.s3_artifacts_key(SUPPORTED_ELM_VERSION))
+        if package_json is None or sources is None:
+            raise ApiError(400, 'package not available: ' +
+                           str(package.name) + '@' + str(package.version))
+
+        _write_files(temp_path, sources, False)
+        with open(os.path.join(temp_path, 'elm-package.json'), 'w') as f:
+            json.dump(package_json, f)
+        if artifacts is not None:
+            _write_files(os.path.join(temp_path, 'artifacts'), artifacts, True)
+        os.rename(temp_path, path)
+    except OSError:
+        # Another worker finished the same package first.
+        shutil.rmtree(temp_path, ignore_errors=True)
+        if not os.path.exists(path):
+            raise
+    except:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    return path
+
+
+def _prepare_project(base_dir: str, elm_code: str, direct: List[Package],
+                     packages: List[Package]) -> None:
+    stuff_dir = os.path.join(base_dir, 'elm-stuff')
+    for package in packages:
+        source = _package_dir(package)
+        name = os.path.join(str(package.name), str(package.version))
+        os.makedirs(os.path.join(stuff_dir, 'packages', str(package.name)),
+                    exist_ok=True)
+        os.symlink(source, os.path.join(stuff_dir, 'packages', name))
+        if os.path.exists(os.path.join(source, 'artifacts')):
+            shutil.copytree(
+                os.path.join(source, 'artifacts'),
+                os.path.join(stuff_dir, 'build-artifacts',
+                             str(SUPPORTED_ELM_VERSION), name))
+
+    with open(os.path.join(stuff_dir, 'exact-dependencies.json'), 'w') as f:
+        json.dump({str(p.name): str(p.version) for p in packages}, f)
+
+    with open(os.path.join(base_dir, 'elm-package.json'), 'w') as f:
+        json.dump({
+            'version': '1.0.0',
+            'summary': 'ellie',
+            'repository': 'https://github.com/user/project.git',
+            'license': 'BSD3',
+            'source-directories': ['src'],
+            'exposed-modules': [],
+            'dependencies': {
+                str(p.name): str(p.version) + ' <= v <= ' + str(p.version)
+                for p in direct
+            },
+            'elm-version': '0.18.0 <= v < 0.19.0'
+        }, f)
+
+    os.makedirs(os.path.join(base_dir, 'src'))
+    with open(os.path.join(base_dir, 'src', 'Main.elm'), 'w') as f:
+        f.write(elm_code)
+
+
+@contextmanager
+def _slot() -> Iterator[None]:
+    os.makedirs(SLOTS_DIR, exist_ok=True)
+    deadline = time.monotonic() + SLOT_WAIT_SECONDS
+    while True:
+        for i in range(COMPILE_WORKERS):
+            f = open(os.path.join(SLOTS_DIR, str(i) + '.lock'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            try:
+                yield
+                return
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+        if time.monotonic() >= deadline:
+            raise ApiError(503, 'the compiler is busy, try again shortly',
+                           retry_after=1)
+        time.sleep(SLOT_POLL_SECONDS)
+
+
+def _run_elm_make(elm_code: str, direct: List[Package],
+                  packages: List[Package]) -> CompileResult:
+    base_dir = tempfile.mkdtemp(prefix='ellie-compile-')
+    try:
+        _prepare_project(base_dir, elm_code, direct, packages)
+        with _slot(), metrics.dependency('elm_make'):
+            process_output = subprocess.run(
+                [ELM_MAKE_PATH, 'src/Main.elm', '--output=build.js', '--yes'],
+                cwd=base_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=COMPILE_TIMEOUT_SECONDS)
+
+        if process_output.returncode != 0:
+            return CompileResult(
+                None, (process_output.stdout +
+                       process_output.stderr).decode('utf-8'))
+
+        with open(os.path.join(base_dir, 'build.js'), 'r') as f:
+            return CompileResult(f.read(), None)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def compile_elm(elm_code: str, packages: List[Package],
+            elm_version: Version) -> CompileResult:
+    for package in packages:
+        if not PACKAGE_NAME_RE.match(str(package.name)):
+            raise ApiError(400, 'invalid package name: ' + str(package.name))
+
+    # Revisions only list their direct dependencies, like elm-package.json;
+    # elm-make needs every package they pull in.
+    resolved = catalog.get_dependency_graph().resolve(elm_version, [
+        (str(p.name), Constraint(p.version, '<=', '<=', p.version))
+        for p in packages
+    ])
+    if resolved is None:
+        raise ApiError(400, 'the dependencies of these packages could not '
+                       'be resolved')
+
+    key = cache_key(elm_code, resolved, elm_version)
+    cached = _read_cached(key)
+    if cached is not None:
+        return cached
+
+    result = _run_elm_make(elm_code, packages, resolved)
+    _write_cached(key, result)
+    return result
@@ -2,3 +2,28 @@ import os
 
 LATEST_TERMS_VERSION = 1
 PRODUCTION = os.environ.get('ENV') == 'production'
+
+DEFAULT_ELM_CODE = '''module Main exposing (main)
+
+import Html exposing (Html, text)
+
+
+main : Html msg
+main =
+    text "Hello, World!"
+'''
+
+DEFAULT_HTML_CODE = '''<html>
+<head>
+  <style>
+    /* you can style your program here */
+  </style>
+</head>
+<body>
+  <script>
+    var app = Elm.Main.fullscreen()
+    // you can use ports and stuff here
+  </script>
+</body>
+</html>
+'''
@@ -0,0 +1,260 @@
+"""In-process timing histograms, exposed in the Prometheus text format.
+
+Metrics are off unless METRICS_ENABLED=1. While disabled, `timed` hands back
+a shared no-op context manager, so instrumented code pays for one attribute
+lookup and a call.
+
+Each gunicorn worker records into its own memory and writes a snapshot to
+METRICS_DIR/<pid>.json every FLUSH_SECONDS. `render` merges the snapshots
+of every worker on the host, so a scrape gives the same totals whichever
+worker answers it. Snapshots of exited workers are kept, so counters do not
+go backwards when a worker is replaced, but their gauges are dropped.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Tuple
+
+ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+METRICS_DIR = os.environ.get(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'ellie-metrics'))
+FLUSH_SECONDS = 5.0
+
+BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0
+]
+
+REQUEST_DURATION = 'ellie_request_duration_seconds'
+DEPENDENCY_DURATION = 'ellie_dependency_duration_seconds'
+
+_HELP = {
+    REQUEST_DURATION: 'Time spent handling a request, by route.',
+    DEPENDENCY_DURATION: 'Time spent in a dependency call, by dependency.'
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms: Dict[str, Dict[Labels, Histogram]] = {}
+_counters: Dict[str, Dict[Labels, int]] = {}
+_gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+
+
+def observe(name: str, labels: Labels, seconds: float) -> None:
+    with _lock:
+        by_labels = _histograms.setdefault(name, {})
+        histogram = by_labels.get(labels)
+        if histogram is None:
+            histogram = by_labels[labels] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name: str, labels: Labels) -> None:
+    if not ENABLED:
+        return
+    with _lock:
+        by_labels = _counters.setdefault(name, {})
+        by_labels[labels] = by_labels.get(labels, 0) + 1
+
+
+def describe(name: str, description: str) -> None:
+    _HELP[name] = description
+
+
+def gauge(name: str, description: str,
+          read: Callable[[], Dict[Labels, float]]) -> None:
+    """Registers a gauge whose values are read from `read` when the
+    metrics are rendered."""
+    describe(name, description)
+    _gauges[name] = read
+
+
+class _Timer(object):
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: Labels) -> None:
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        observe(self.name, self.labels, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timed(name: str, **labels: str) -> Any:
+    if not ENABLED:
+        return _null_timer
+    return _Timer(name, tuple(sorted(labels.items())))
+
+
+def dependency(name: str) -> Any:
+    if not ENABLED:
+        return _null_timer
+    return _Timer(DEPENDENCY_DURATION, (('dependency', name), ))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        key + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for key, value in pairs) + '}'
+
+
+def _snapshot() -> Dict[str, Any]:
+    with _lock:
+        histograms = {
+            name: [[labels, h.counts, h.sum, h.count]
+                   for labels, h in by_labels.items()]
+            for name, by_labels in _histograms.items()
+        }
+        counters = {
+            name: list(by_labels.items())
+            for name, by_labels in _counters.items()
+        }
+    gauges = {name: list(read().items()) for name, read in _gauges.items()}
+    return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+
+_write_lock = threading.Lock()
+
+
+def _write_snapshot() -> None:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, str(os.getpid()) + '.json')
+    temp_path = path + '.tmp'
+    with _write_lock:
+        with open(temp_path, 'w') as f:
+            json.dump(_snapshot(), f)
+        os.rename(temp_path, path)
+
+
+def _flush() -> None:
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            _write_snapshot()
+        except Exception as e:
+            print('metrics: could not write snapshot: ' + str(e))
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _labels(data: List[List[str]]) -> Labels:
+    return tuple((key, value) for key, value in data)
+
+
+def _merged() -> Tuple[Dict[str, Dict[Labels, Histogram]],
+                       Dict[str, Dict[Labels, int]],
+                       Dict[str, Dict[Labels, float]]]:
+    _write_snapshot()
+    histograms: Dict[str, Dict[Labels, Histogram]] = {}
+    counters: Dict[str, Dict[Labels, int]] = {}
+    gauges: Dict[str, Dict[Labels, float]] = {}
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename), 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        for name, rows in snapshot['histograms'].items():
+            merged_histograms = histograms.setdefault(name, {})
+            for labels, counts, total, count in rows:
+                histogram = merged_histograms.setdefault(_labels(labels),
+                                                         Histogram())
+                for i, bucket_count in enumerate(counts):
+                    histogram.counts[i] += bucket_count
+                histogram.sum += total
+                histogram.count += count
+        for name, rows in snapshot['counters'].items():
+            merged_counters = counters.setdefault(name, {})
+            for labels, value in rows:
+                key = _labels(labels)
+                merged_counters[key] = merged_counters.get(key, 0) + value
+        if _is_alive(int(filename[:-len('.json')])):
+            for name, rows in snapshot['gauges'].items():
+                merged_gauges = gauges.setdefault(name, {})
+                for labels, value in rows:
+                    key = _labels(labels)
+                    merged_gauges[key] = merged_gauges.get(key, 0.0) + value
+    return histograms, counters, gauges
+
+
+def render() -> str:
+    """The metrics of every worker on this host, summed."""
+    histograms, counters, gauges = _merged()
+    lines: List[str] = []
+    for name in sorted(histograms):
+        lines.append('# HELP ' + name + ' ' + _HELP.get(name, name))
+        lines.append('# TYPE ' + name + ' histogram')
+        for labels, histogram in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + [float('inf')],
+                                    histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(name + '_bucket' + _format_labels(
+                    labels, (('le', le), )) + ' ' + str(cumulative))
+            lines.append(name + '_sum' + _format_labels(labels) + ' ' +
+                         repr(histogram.sum))
+            lines.append(name + '_count' + _format_labels(labels) + ' ' +
+                         str(histogram.count))
+    for name in sorted(counters):
+        lines.append('# HELP ' + name + ' ' + _HELP.get(name, name))
+        lines.append('# TYPE ' + name + ' counter')
+        for labels, count in sorted(counters[name].items()):
+            lines.append(name + _format_labels(labels) + ' ' + str(count))
+    for name in sorted(gauges):
+        lines.append('# HELP ' + name + ' ' + _HELP.get(name, name))
+        lines.append('# TYPE ' + name + ' gauge')
+        for labels, value in sorted(gauges[name].items()):
+            lines.append(name + _format_labels(labels) + ' ' + repr(value))
+    return '\n'.join(lines) + '\n'
+
+
+if ENABLED:
+    threading.Thread(target=_flush, daemon=True).start()
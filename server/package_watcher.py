@@ -0,0 +1,74 @@
+"""Tells web workers when the sync process has published a new package
+snapshot.
+
+`sync_packages.run` rewrites `package-artifacts/last-updated` after uploading
+searchable.json. Each worker polls that object's ETag from a background
+thread and calls its listeners when it changes, so request handlers never
+check timestamps or block on a refresh themselves.
+"""
+import os
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from . import metrics
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+MARKER_KEY = 'package-artifacts/last-updated'
+POLL_SECONDS = int(os.environ.get('PACKAGE_SNAPSHOT_POLL_SECONDS', '30'))
+
+client = boto3.client('s3')
+
+
+def read_marker() -> Optional[str]:
+    try:
+        with metrics.dependency('s3_head_object'):
+            return client.head_object(
+                Bucket=BUCKET_NAME, Key=MARKER_KEY).get('ETag')
+    except ClientError:
+        return None
+
+
+# Read before any snapshot is built, so a sync that lands while a worker is
+# starting up is still picked up on the first poll.
+_marker = read_marker()
+_listeners: List[Callable[[], None]] = []
+_lock = threading.Lock()
+_watcher_pid: Optional[int] = None
+
+
+def _notify() -> bool:
+    succeeded = True
+    for listener in list(_listeners):
+        try:
+            listener()
+        except Exception:
+            traceback.print_exc()
+            succeeded = False
+    return succeeded
+
+
+def _watch() -> None:
+    global _marker
+    while True:
+        time.sleep(POLL_SECONDS)
+        marker = read_marker()
+        # Only moved forward once every listener has caught up, so a failed
+        # refresh is retried on the next poll instead of waiting for the
+        # next sync.
+        if marker is not None and marker != _marker and _notify():
+            _marker = marker
+
+
+def subscribe(listener: Callable[[], None]) -> None:
+    global _watcher_pid
+    with _lock:
+        _listeners.append(listener)
+        # Threads do not survive a fork, so each worker starts its own.
+        if _watcher_pid != os.getpid():
+            _watcher_pid = os.getpid()
+            threading.Thread(target=_watch, daemon=True).start()
@@ -0,0 +1,158 @@
+"""Dependency resolution over the graph `sync_packages` writes to
+package-artifacts/dependencies.json:
+
+    {"user/project": {"1.0.0": {"elmVersion": "0.18.0 <= v < 0.19.0",
+                                "dependencies": {"user/dep": "..."}}}}
+
+Elm allows one version of each package in a project, so solving is a
+depth-first search that picks the newest version satisfying every
+constraint seen so far and backtracks when a later one conflicts. The
+search keeps its own stack of open choices rather than recursing, so the
+number of requirements is not limited by Python's recursion limit.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from .classes import (ApiError, Constraint, Package, Version, intern_package,
+                      intern_package_name)
+
+MAX_CACHED_SOLUTIONS = 1024
+
+# Bounds the search so a pathological request cannot tie up a worker.
+MAX_STEPS = 20000
+
+# Most requests a project's elm-package.json could plausibly make.
+MAX_REQUIREMENTS = 200
+
+Requirement = Tuple[str, Constraint]
+
+class PackageVersion(NamedTuple):
+    version: Version
+    elm_constraint: Constraint
+    dependencies: List[Requirement]
+
+
+class DependencyGraph(object):
+    def __init__(self, packages: Dict[str, List[PackageVersion]]) -> None:
+        self._packages = packages
+        self._lock = threading.Lock()
+        self._solutions: 'OrderedDict[Any, Optional[List[Package]]]' = \
+            OrderedDict()
+
+    def _solve(self, elm_version: Version,
+               requirements: List[Requirement]) -> Optional[List[Package]]:
+        chosen: Dict[str, Version] = {}
+        # Requirements are handled in the order they were added, and a
+        # chosen package's dependencies go on the end.
+        queue = list(requirements)
+        position = 0
+        # Open choices, oldest first, as [name, candidates, index of the
+        # candidate in use, queue position and length when it was made].
+        choices: List[List[Any]] = []
+        steps = 0
+
+        def next_candidate() -> bool:
+            nonlocal position
+            while choices:
+                choice = choices[-1]
+                choice[2] += 1
+                if choice[2] < len(choice[1]):
+                    candidate = choice[1][choice[2]]
+                    chosen[choice[0]] = candidate.version
+                    position = choice[3]
+                    del queue[choice[4]:]
+                    queue.extend(candidate.dependencies)
+                    return True
+                chosen.pop(choice[0], None)
+                choices.pop()
+            return False
+
+        while position < len(queue):
+            steps += 1
+            if steps > MAX_STEPS:
+                raise ApiError(422, 'these dependencies are too complex to '
+                               'resolve, try narrowing their constraints')
+
+            name, constraint = queue[position]
+            position += 1
+            if name in chosen:
+                if constraint.is_satisfied(chosen[name]):
+                    continue
+            else:
+                choices.append([name, [
+                    candidate for candidate in self._packages.get(name, [])
+                    if constraint.is_satisfied(candidate.version) and
+                    candidate.elm_constraint.is_satisfied(elm_version)
+                ], -1, position, len(queue)])
+            if not next_candidate():
+                return None
+
+        output = []
+        for name, version in sorted(chosen.items()):
+            user, project = name.split('/')
+            output.append(
+                intern_package(intern_package_name(user, project), version))
+        return output
+
+    def resolve(self, elm_version: Version,
+                requirements: List[Requirement]) -> Optional[List[Package]]:
+        """Returns the packages, direct and indirect, that satisfy every
+        requirement, or None if there is no such set. Raises ApiError if
+        the search gives up first; that outcome is not cached."""
+        key = (elm_version, tuple(sorted(
+            (name, str(constraint)) for name, constraint in requirements)))
+        with self._lock:
+            if key in self._solutions:
+                self._solutions.move_to_end(key)
+                return self._solutions[key]
+
+        solution = self._solve(elm_version, requirements)
+
+        with self._lock:
+            self._solutions[key] = solution
+            if len(self._solutions) > MAX_CACHED_SOLUTIONS:
+                self._solutions.popitem(last=False)
+        return solution
+
+    @staticmethod
+    def from_json(data: Dict[str, Dict[str, Any]]) -> 'DependencyGraph':
+        constraints: Dict[str, Optional[Constraint]] = {}
+
+        def constraint(string: str) -> Optional[Constraint]:
+            if string not in constraints:
+                constraints[string] = Constraint.from_string(string)
+            return constraints[string]
+
+        packages: Dict[str, List[PackageVersion]] = {}
+        for name, versions in data.items():
+            entries = []
+            for version_string, entry in versions.items():
+                version = Version.from_string(version_string)
+                elm_constraint = constraint(entry['elmVersion'])
+                if version is None or elm_constraint is None:
+                    continue
+                parsed = [
+                    (dependency, constraint(string))
+                    for dependency, string in entry['dependencies'].items()
+                ]
+                dependencies: List[Requirement] = [
+                    (dependency, c) for dependency, c in parsed
+                    if c is not None
+                ]
+                if len(dependencies) != len(parsed):
+                    continue
+                entries.append(
+                    PackageVersion(version, elm_constraint, dependencies))
+            entries.sort(key=lambda e: e.version, reverse=True)
+            packages[name] = entries
+        return DependencyGraph(packages)
+
+    @staticmethod
+    def load(path: str) -> 'DependencyGraph':
+        try:
+            with open(path, 'r') as f:
+                return DependencyGraph.from_json(json.load(f))
+        except FileNotFoundError:
+            return DependencyGraph({})
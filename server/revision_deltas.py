@@ -0,0 +1,86 @@
+"""Delta encoding for stored revisions.
+
+A project's revisions can be rewritten by scripts/compact_revisions.py so
+that every KEYFRAME_INTERVAL-th revision stays a full document and the rest
+are stored, under the same key, as a delta against the nearest keyframe
+before them:
+
+    {"format": "delta-1",
+     "base": 32,
+     "text": {"elmCode": [[0, 12], "changed line\\n", [13, 40]], ...},
+     "values": {"packages": [...], "id": {...}, ...}}
+
+Text fields are diffed by line. Each op is either a `[start, end)` range of
+the base's lines to copy or a string to insert. Other fields are stored
+whole. Since deltas only point at keyframes, reading any revision takes at
+most two objects.
+"""
+from difflib import SequenceMatcher
+from typing import Any, Dict, List
+
+DELTA_FORMAT = 'delta-1'
+KEYFRAME_INTERVAL = 16
+TEXT_FIELDS = ['elmCode', 'htmlCode', 'title', 'description']
+
+
+def is_delta(data: Any) -> bool:
+    return isinstance(data, dict) and data.get('format') == DELTA_FORMAT
+
+
+def keyframe_for(revision_number: int,
+                 interval: int = KEYFRAME_INTERVAL) -> int:
+    return revision_number - revision_number % interval
+
+
+def _diff_text(base: str, target: str) -> List[Any]:
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops: List[Any] = []
+    matcher = SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            inserted = ''.join(target_lines[j1:j2])
+            # Merge with a preceding insert so replacements stay one op.
+            if ops and isinstance(ops[-1], str):
+                ops[-1] += inserted
+            else:
+                ops.append(inserted)
+    return ops
+
+
+def _apply_text(base: str, ops: List[Any]) -> str:
+    base_lines = base.splitlines(keepends=True)
+    output = []
+    for op in ops:
+        if isinstance(op, str):
+            output.append(op)
+        else:
+            output.extend(base_lines[op[0]:op[1]])
+    return ''.join(output)
+
+
+def encode(base_number: int, base: Dict[str, Any],
+           target: Dict[str, Any]) -> Dict[str, Any]:
+    text = {}
+    values = {}
+    for key, value in target.items():
+        if key in TEXT_FIELDS and isinstance(value, str) and \
+                isinstance(base.get(key), str):
+            text[key] = _diff_text(base[key], value)
+        else:
+            values[key] = value
+    return {
+        'format': DELTA_FORMAT,
+        'base': base_number,
+        'text': text,
+        'values': values
+    }
+
+
+def apply(base: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    output = dict(delta['values'])
+    for key, ops in delta['text'].items():
+        output[key] = _apply_text(base[key], ops)
+    return output
@@ -0,0 +1,45 @@
+"""Reading and writing revision objects that may be gzip-encoded.
+
+Revisions uploaded with a gzip presigned policy, or re-encoded by
+scripts/gzip_revisions.py, are stored with `Content-Encoding: gzip`. S3
+does not decode them on the way out, so readers go through `read_body`.
+"""
+import zlib
+from typing import Any
+
+GZIP = 'gzip'
+CHUNK_SIZE = 64 * 1024
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_gzip(response: Any) -> bool:
+    return response.get('ContentEncoding') == GZIP
+
+
+def read_body(response: Any) -> bytes:
+    """Reads a get_object response body, decompressing it chunk by chunk as
+    it arrives when the object is gzip-encoded."""
+    body = response['Body']
+    try:
+        first = body.read(CHUNK_SIZE)
+        if not is_gzip(response) and not first.startswith(_GZIP_MAGIC):
+            return first + body.read()
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output = [decompressor.decompress(first)]
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            output.append(decompressor.decompress(chunk))
+        output.append(decompressor.flush())
+        return b''.join(output)
+    finally:
+        body.close()
+
+
+def encode(data: bytes) -> bytes:
+    # zlib writes a zero mtime into the gzip header, unlike gzip.compress,
+    # so the same revision always encodes to the same bytes.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -3,8 +3,11 @@ import os
 import re
 import subprocess
 import sys
+import time
 import traceback
 from datetime import datetime, timedelta
+from hashlib import sha1
+from hmac import compare_digest
 from itertools import *
 from operator import *
 from typing import (Any, Dict, Iterator, List, NamedTuple, Optional, Tuple,
@@ -13,14 +16,15 @@ from urllib.parse import urlparse
 
 import boto3
 import botocore
-from flask import (Flask, jsonify, redirect, render_template, request, session,
-                   url_for)
+from flask import (Flask, g, jsonify, redirect, render_template, request,
+                   session, url_for)
 from opbeat.contrib.flask import Opbeat
 from werkzeug.routing import BaseConverter, HTTPException, ValidationError
 
-from . import assets, constants, package_search, storage
+from . import (admission, assets, catalog, compiler, constants, metrics,
+               package_search, resolver, storage)
 from .classes import (ApiError, Constraint, Package, PackageInfo, PackageName,
-                      ProjectId, Version)
+                      ProjectId, RenderedJson, Version)
 
 T = TypeVar('T')
 
@@ -48,8 +52,11 @@ if constants.PRODUCTION:
 
 
 class ProjectIdConverter(BaseConverter):
-    def to_python(self, value: str) -> Optional[ProjectId]:
-        return ProjectId.from_string(value)
+    def to_python(self, value: str) -> ProjectId:
+        project_id = ProjectId.from_string(value)
+        if project_id is None:
+            raise ValidationError()
+        return project_id
 
     def to_url(self, value: ProjectId) -> str:
         return str(value)
@@ -58,10 +65,53 @@ class ProjectIdConverter(BaseConverter):
 app.url_map.converters['project_id'] = ProjectIdConverter
 
 
+if metrics.ENABLED:
+    @app.before_request
+    def start_request_timer() -> None:
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response: Any) -> Any:
+        started = g.get('request_started')
+        if started is not None:
+            rule = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe(metrics.REQUEST_DURATION,
+                            (('method', request.method),
+                             ('route', rule),
+                             ('status', str(response.status_code))),
+                            time.perf_counter() - started)
+        return response
+
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Scrapers send this as a bearer token. Without it, /metrics is only served
+# to local requests, which never happens behind the Heroku router.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+def metrics_authorized() -> bool:
+    if METRICS_TOKEN:
+        return compare_digest(
+            request.headers.get('Authorization', '').encode('utf-8'),
+            ('Bearer ' + METRICS_TOKEN).encode('utf-8'))
+    return request.remote_addr in LOCAL_ADDRESSES
+
+
+@app.route('/metrics')
+def get_metrics() -> Any:
+    if not metrics.ENABLED or not metrics_authorized():
+        raise ApiError(404, 'not found')
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+
 @app.errorhandler(ApiError)
 def handle_error(error: ApiError) -> Any:
     response = jsonify({'status': error.status_code, 'message': error.message})
     response.status_code = error.status_code
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(error.retry_after)
     return response
 
 
@@ -100,15 +150,28 @@ def accept_terms(terms_version: int) -> Any:
     return jsonify({})
 
 
+# Revisions are write-once, so anything derived only from a revision can be
+# cached indefinitely.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def rendered_json_response(rendered: RenderedJson,
+                           cache_control: Optional[str] = None) -> Any:
+    response = app.response_class(rendered.body, mimetype='application/json')
+    response.set_etag(rendered.etag)
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request.environ)
+
+
 @app.route('/api/packages/<string:user>/<string:project>/versions')
 def tags(user: str, project: str) -> Any:
-    cache_data = storage.get_searchable_packages()
-    key = PackageName(user, project)
+    rendered = catalog.get_versions_json(user, project)
 
-    if key not in cache_data:
+    if rendered is None:
         raise ApiError(404, 'Package not found')
 
-    return jsonify([v.to_json() for v in cache_data[key].versions])
+    return rendered_json_response(rendered)
 
 
 @app.route('/api/search')
@@ -130,7 +193,45 @@ def search() -> Any:
     return jsonify([p.to_json() for p in packages])
 
 
+@app.route('/api/packages/resolve', methods=['POST'])
+@admission.limit('resolve')
+def resolve_packages() -> Any:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError(400, 'request body must be a JSON object')
+
+    elm_version = data.get('elmVersion')
+    parsed_elm_version = Version.from_string(elm_version) if isinstance(
+        elm_version, str) else None
+    if parsed_elm_version is None:
+        raise ApiError(400, 'elm version must be a semver string like 0.18.0')
+
+    dependencies = data.get('dependencies')
+    if not isinstance(dependencies, dict):
+        raise ApiError(400, 'dependencies must map package names to '
+                       'constraints like "1.0.0 <= v < 2.0.0"')
+    if len(dependencies) > resolver.MAX_REQUIREMENTS:
+        raise ApiError(400, 'at most ' + str(resolver.MAX_REQUIREMENTS) +
+                       ' dependencies can be resolved at once')
+
+    requirements = []
+    for name, constraint_string in dependencies.items():
+        constraint = Constraint.from_string(constraint_string) if isinstance(
+            constraint_string, str) else None
+        if PackageName.from_json(name) is None or constraint is None:
+            raise ApiError(400, 'invalid dependency ' + json.dumps(name))
+        requirements.append((name, constraint))
+
+    packages = catalog.get_dependency_graph().resolve(parsed_elm_version,
+                                                      requirements)
+    if packages is None:
+        raise ApiError(404, 'no set of packages satisfies these dependencies')
+
+    return jsonify([p.to_json() for p in packages])
+
+
 @app.route('/api/upload')
+@admission.limit('upload')
 def get_upload_urls() -> Any:
     project_id_string = request.args.get('projectId')
 
@@ -172,57 +273,92 @@ def get_upload_urls() -> Any:
 
 @app.route('/api/revisions/default')
 def get_default_revision() -> Any:
-    cache_data = storage.get_searchable_packages()
-    default_html = cache_data[PackageName(
-        'elm-lang', 'html')].latest_by_elm_version[Version(0, 18, 0)]
-    default_core = cache_data[PackageName(
-        'elm-lang', 'core')].latest_by_elm_version[Version(0, 18, 0)]
-
-    return jsonify({
-        'packages': [default_core.to_json(), default_html.to_json()],
-        'elmVersion': '0.18.0',
-        'title': '',
-        'description': '',
-        'id': None,
-        'elmCode': '''module Main exposing (main)
-
-import Html exposing (Html, text)
-
-
-main : Html msg
-main =
-    text "Hello, World!"
-''',
-        'htmlCode': '''<html>
-<head>
-  <style>
-    /* you can style your program here */
-  </style>
-</head>
-<body>
-  <script>
-    var app = Elm.Main.fullscreen()
-    // you can use ports and stuff here
-  </script>
-</body>
-</html>
-'''
-    })
+    return rendered_json_response(catalog.get_default_revision_json())
 
 
 @app.route('/api/revisions/<project_id:project_id>/<int(min=0):revision_number>')
 def get_revision(project_id: ProjectId, revision_number: int) -> Any:
-    revision = storage.get_revision(project_id, revision_number)
-    if revision is None:
-        raise ApiError(404, 'revision not found')
-    return jsonify(revision.to_json())
+    # The body is fixed for a given revision and `owned` flag, so the ETag
+    # can be checked before fetching anything from S3.
+    owned = storage.project_id_is_owned(project_id)
+    etag = sha1((str(project_id) + '/' + str(revision_number) + '/' +
+                 str(owned)).encode('utf-8')).hexdigest()
+
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        revision = storage.get_revision(project_id, revision_number)
+        if revision is None:
+            raise ApiError(404, 'revision not found')
+        response = jsonify(revision.to_json())
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    # The `owned` flag comes from the ownedProjects cookie.
+    response.vary.add('Cookie')
+    return response
 
 
 def remove_ansi_colors(input: str) -> str:
     return re.sub(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]', '', input)
 
 
+def compile_response(elm_code: str, packages: List[Package],
+                     elm_version: Version) -> Any:
+    if not compiler.ENABLED:
+        raise ApiError(404, 'server-side compilation is not enabled')
+    if elm_version != compiler.SUPPORTED_ELM_VERSION:
+        raise ApiError(400, 'only elm ' + str(compiler.SUPPORTED_ELM_VERSION) +
+                       ' can be compiled on the server')
+
+    try:
+        result = compiler.compile_elm(elm_code, packages, elm_version)
+    except subprocess.TimeoutExpired:
+        raise ApiError(503, 'compilation timed out')
+
+    if result.error is not None:
+        raise ApiError(400, remove_ansi_colors(result.error))
+    return jsonify({'result': result.js})
+
+
+@app.route('/api/compile', methods=['POST'])
+@admission.limit('compile')
+def compile_elm() -> Any:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('elmCode'), str) or \
+            not isinstance(data.get('packages'), list):
+        raise ApiError(400, 'elmCode must be a string and packages a list')
+
+    elm_version = Version.from_json(data.get('elmVersion', '0.18.0'))
+    if elm_version is None:
+        raise ApiError(400, 'elm version must be a semver string like 0.18.0')
+
+    packages = list(cat_optionals(
+        Package.from_json(p) for p in data['packages']
+        if isinstance(p, list) and len(p) == 2 and isinstance(p[0], str)))
+    if len(packages) != len(data['packages']):
+        raise ApiError(400, 'packages must be [name, version] pairs')
+
+    return compile_response(data['elmCode'], packages, elm_version)
+
+
+@app.route('/api/revisions/<project_id:project_id>/<int(min=0):revision_number>/compiled')
+@admission.limit('compile')
+def get_compiled_revision(project_id: ProjectId, revision_number: int) -> Any:
+    revision = storage.get_revision(project_id, revision_number)
+    if revision is None:
+        raise ApiError(404, 'revision not found')
+
+    response = compile_response(revision.elm_code, revision.packages,
+                                revision.elm_version)
+    # Revisions never change once saved, so neither does their output.
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
 @app.route('/api/format', methods=['POST'])
+@admission.limit('format')
 def format() -> Any:
     data: Dict[str, Any] = request.get_json()
     maybe_source: Optional[str] = data['source']
@@ -234,11 +370,12 @@ def format() -> Any:
     elm_format_path = os.path.realpath(
         os.path.dirname(os.path.realpath(__file__)) +
         '/../node_modules/.bin/elm-format')
-    process_output = subprocess.run(
-        [elm_format_path, '--stdin'],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        input=maybe_source.encode('utf-8'))
+    with metrics.dependency('elm_format'):
+        process_output = subprocess.run(
+            [elm_format_path, '--stdin'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            input=maybe_source.encode('utf-8'))
 
     if process_output.returncode != 0:
         stderr_as_str = process_output.stderr.decode('utf-8')
@@ -261,6 +398,23 @@ EDITOR_CONSTANTS = {
 }
 
 
+def render_page(template: str, bundle: str, page_constants: Dict[str, Any],
+                data: Any) -> Any:
+    if not assets.has_compressed_variants():
+        return render_template(template, constants=page_constants, data=data)
+
+    # Point at the precompressed bundles this client can decode.
+    page_constants = dict(page_constants)
+    page_constants['APP_JS'] = assets.asset_path(bundle + '.js',
+                                                 request.accept_encodings)
+    page_constants['APP_CSS'] = assets.asset_path(bundle + '.css',
+                                                  request.accept_encodings)
+    response = app.make_response(
+        render_template(template, constants=page_constants, data=data))
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 @app.route('/')
 @app.route('/new')
 def new() -> Any:
@@ -268,7 +422,7 @@ def new() -> Any:
         'accepted_terms_version': session.get('v1', {}).get('accepted_terms_version')
     }
 
-    return render_template('new.html', constants=EDITOR_CONSTANTS, data=data)
+    return render_page('new.html', 'editor', EDITOR_CONSTANTS, data)
 
 
 @app.route('/<project_id:project_id>/<int(min=0):revision_number>')
@@ -278,18 +432,18 @@ def existing(project_id: ProjectId, revision_number: int) -> Any:
                       revision_number=revision_number)
         return redirect(url, code=301)
 
-    revision = storage.get_revision(project_id, revision_number)
-    if revision is None:
+    metadata = storage.get_revision_metadata(project_id, revision_number)
+    if metadata is None:
         return redirect('new', code=303)
 
     data = {
         'accepted_terms_version': session.get('v1', {}).get('accepted_terms_version'),
-        'title': revision.title,
-        'description': revision.description,
+        'title': metadata.title,
+        'description': metadata.description,
         'url': EDITOR_CONSTANTS['SERVER_HOSTNAME'] + '/' + str(project_id) + '/' + str(revision_number)
     }
 
-    return render_template('existing.html', constants=EDITOR_CONSTANTS, data=data)
+    return render_page('existing.html', 'editor', EDITOR_CONSTANTS, data)
 
 
 EMBED_CONSTANTS = {
@@ -317,14 +471,14 @@ def embed(project_id: ProjectId, revision_number: int) -> Any:
         return redirect(url, code=301)
 
     data = {}
-    revision = storage.get_revision(project_id, revision_number)
-    if revision is not None:
-        data['title'] = revision.title
-        data['description'] = revision.description
+    metadata = storage.get_revision_metadata(project_id, revision_number)
+    if metadata is not None:
+        data['title'] = metadata.title
+        data['description'] = metadata.description
         data['url'] = EMBED_CONSTANTS['SERVER_HOSTNAME'] + \
             '/embed/' + str(project_id) + '/' + str(revision_number)
 
-    return render_template('embed.html', constants=EMBED_CONSTANTS, data=data)
+    return render_page('embed.html', 'embed', EMBED_CONSTANTS, data)
 
 
 @app.route('/oembed')
@@ -354,17 +508,17 @@ def oembed() -> Any:
     if revision_number is None:
         raise ApiError(404, 'revision not found')
 
-    revision = storage.get_revision(project_id, revision_number)
-    if revision is None:
+    metadata = storage.get_revision_metadata(project_id, revision_number)
+    if metadata is None:
         raise ApiError(404, 'revision not found')
 
-    return jsonify({
+    return rendered_json_response(RenderedJson.render({
         'width': width,
         'height': height,
         'type': 'rich',
         'version': '1.0',
-        'title': revision.title,
+        'title': metadata.title,
         'provider_name': 'ellie-app.com',
         'provider_url': 'https://ellie-app.com',
         'html': '<iframe src="' + EDITOR_CONSTANTS['SERVER_HOSTNAME'] + '/embed/' + str(project_id) + '/' + str(revision_number) + '" width=' + str(width) + ' height=' + str(height) + ' frameBorder="0" allowtransparency="true"></iframe>'
-    })
+    }), IMMUTABLE_CACHE_CONTROL)
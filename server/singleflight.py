@@ -0,0 +1,51 @@
+"""Coalesces concurrent calls for the same key into one.
+
+The first caller for a key runs the function; callers arriving while it is
+in flight wait for it and receive the same result, or the same exception.
+Nothing is remembered once the call finishes, so errors are never cached
+and the next caller after that starts a fresh call.
+
+Calls are only shared between threads of one process, which is why the web
+process runs gunicorn's threaded workers (see Procfile).
+"""
+import threading
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class _Call(Generic[T]):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+
+
+class Group(Generic[T]):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call[T]] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result  # type: ignore
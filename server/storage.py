@@ -2,19 +2,22 @@ import base64
 import json
 import os
 import re
-from datetime import datetime, timedelta
+import threading
+import zlib
+from collections import OrderedDict
 from hashlib import sha256
+from hmac import compare_digest
 from hmac import new as hmac
-from typing import (Any, Dict, Iterator, List, NamedTuple, Optional, Pattern,
-                    Set, TypeVar)
+from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Pattern, Set, Tuple, TypeVar)
 from urllib.parse import quote, unquote
 
 import boto3
 import botocore
-from flask import request
+from flask import g, request
 
-from .classes import (Package, PackageInfo, PackageName, ProjectId, Revision,
-                      Version)
+from . import metrics, revision_deltas, revision_encoding, singleflight
+from .classes import ProjectId, Revision, RevisionMetadata
 
 BUCKET_NAME = os.environ['AWS_S3_BUCKET']
 
@@ -31,18 +34,30 @@ cookie_key = os.environ['COOKIE_SECRET'].encode('utf-8')
 replace_re: Pattern = re.compile('\=+$')
 
 
-def _sign_cookie(value: str) -> str:
+def _cookie_mac(value: str) -> str:
     mac = hmac(cookie_key, msg=None, digestmod=sha256)
     mac.update(value.encode('utf-8'))
     b64 = base64.b64encode(mac.digest())
-    replaced = b64.decode('utf-8').rstrip('=')
-    return quote('s:' + value + '.' + replaced, safe='')
+    return b64.decode('utf-8').rstrip('=')
+
+
+def _sign_cookie(value: str) -> str:
+    return quote('s:' + value + '.' + _cookie_mac(value), safe='')
 
 
 def _unsign_cookie(value: str) -> Optional[str]:
-    unsigned_value = unquote(value[0:value.rfind('.')]).replace('s:', '')
-    to_match = _sign_cookie(unsigned_value)
-    return unsigned_value if to_match == value else None
+    raw = unquote(value)
+    dot = raw.rfind('.')
+    if not raw.startswith('s:') or dot < 0:
+        return None
+
+    unsigned_value = raw[2:dot]
+    # compare_digest only accepts ASCII str, and the MAC part of a forged
+    # cookie need not be.
+    if not compare_digest(_cookie_mac(unsigned_value).encode('utf-8'),
+                          raw[dot + 1:].encode('utf-8')):
+        return None
+    return unsigned_value
 
 
 s3 = boto3.resource('s3')
@@ -50,21 +65,78 @@ client = boto3.client('s3')
 bucket = s3.Bucket(BUCKET_NAME)
 
 
-def _get_owned_project_ids() -> Set[ProjectId]:
+# Owned project ids are stored oldest first as zigzag, LEB128-packed deltas
+# between consecutive ids, then base64url encoded. Older cookies hold a JSON
+# list of id strings and are still accepted.
+OWNED_PROJECTS_PREFIX = 'b1:'
+MAX_OWNED_PROJECTS = 256
+
+# Whether presigned revision uploads must be gzip-encoded. Only turn this on
+# once the client compresses what it uploads.
+GZIP_REVISION_UPLOADS = os.environ.get('GZIP_REVISION_UPLOADS') == '1'
+
+
+def _encode_owned_project_ids(project_ids: Iterable[ProjectId]) -> str:
+    output = bytearray()
+    previous = 0
+    for project_id in project_ids:
+        delta = int(project_id) - previous
+        previous = int(project_id)
+        zigzag = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+        while zigzag > 0x7f:
+            output.append((zigzag & 0x7f) | 0x80)
+            zigzag >>= 7
+        output.append(zigzag)
+    encoded = base64.urlsafe_b64encode(bytes(output)).decode('ascii')
+    return OWNED_PROJECTS_PREFIX + encoded.rstrip('=')
+
+
+def _decode_owned_project_ids(value: str) -> List[ProjectId]:
+    encoded = value[len(OWNED_PROJECTS_PREFIX):]
+    data = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    output = []
+    previous = 0
+    zigzag = 0
+    shift = 0
+    for byte in data:
+        zigzag |= (byte & 0x7f) << shift
+        shift += 7
+        if byte & 0x80:
+            continue
+        delta = zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1)
+        previous += delta
+        output.append(ProjectId(previous, 1))
+        zigzag = 0
+        shift = 0
+    return output
+
+
+def _parse_owned_project_ids() -> 'OrderedDict[ProjectId, None]':
     raw = request.cookies.get('ownedProjects')
     if raw is None:
-        return set()
+        return OrderedDict()
 
-    unsigned = _unsign_cookie(raw)
+    with metrics.dependency('cookie_verify'):
+        unsigned = _unsign_cookie(raw)
     if unsigned is None:
-        return set()
+        return OrderedDict()
 
     try:
-        return set(
-            cat_optionals(
+        if unsigned.startswith(OWNED_PROJECTS_PREFIX):
+            project_ids = _decode_owned_project_ids(unsigned)
+        else:
+            project_ids = list(cat_optionals(
                 ProjectId.from_string(x) for x in json.loads(unsigned)))
+        return OrderedDict((x, None) for x in project_ids)
     except:
-        return set()
+        return OrderedDict()
+
+
+def _get_owned_project_ids() -> 'OrderedDict[ProjectId, None]':
+    # Parsed once per request and shared by every ownership check.
+    if 'owned_project_ids' not in g:
+        g.owned_project_ids = _parse_owned_project_ids()
+    return g.owned_project_ids
 
 
 def project_id_is_owned(project_id: ProjectId) -> bool:
@@ -73,32 +145,121 @@ def project_id_is_owned(project_id: ProjectId) -> bool:
 
 def add_project_id_ownership(project_id: ProjectId, response: Any) -> None:
     project_ids = _get_owned_project_ids()
-    project_ids.add(project_id)
-    cookie_string = json.dumps([str(x) for x in project_ids])
+    project_ids.pop(project_id, None)
+    project_ids[project_id] = None
+    while len(project_ids) > MAX_OWNED_PROJECTS:
+        project_ids.popitem(last=False)
+    cookie_string = _encode_owned_project_ids(project_ids)
     response.set_cookie('ownedProjects', _sign_cookie(cookie_string))
 
 
+def _get_revision_json(project_id: ProjectId, revision_number: int) -> Any:
+    key = 'revisions/' + str(project_id) + '/' + str(revision_number) + '.json'
+    with metrics.dependency('s3_get_object'):
+        raw = revision_encoding.read_body(
+            client.get_object(Bucket=BUCKET_NAME, Key=key))
+    return json.loads(raw)
+
+
+def _load_revision_json(project_id: ProjectId, revision_number: int) -> Any:
+    json_data = _get_revision_json(project_id, revision_number)
+    if revision_deltas.is_delta(json_data):
+        base = _get_revision_json(project_id, json_data['base'])
+        json_data = revision_deltas.apply(base, json_data)
+    return json_data
+
+
+# Concurrent requests for the same revision share one fetch.
+_revision_fetches: 'singleflight.Group[Any]' = singleflight.Group()
+
+
 def get_revision(project_id: ProjectId,
                  revision_number: int) -> Optional[Revision]:
     try:
-        key = 'revisions/' + str(project_id) + '/' + str(
-            revision_number) + '.json'
-        data = client.get_object(Bucket=BUCKET_NAME, Key=key)
-        body = data['Body']
-        json_data = json.loads(body.read())
+        # Copied, since every waiter gets the same dict and adds its own
+        # `owned` flag.
+        json_data = dict(_revision_fetches.do(
+            (project_id, revision_number),
+            lambda: _load_revision_json(project_id, revision_number)))
         json_data['owned'] = project_id_is_owned(project_id)
-        revision = Revision.from_json(json_data)
-        body.close()
-        return revision
+        return Revision.from_json(json_data)
     except Exception as e:
         return None
 
 
+# Revisions never change once saved, so their metadata can be kept for as
+# long as there is room.
+MAX_CACHED_METADATA = 4096
+_metadata_cache: 'OrderedDict[Tuple[ProjectId, int], RevisionMetadata]' = \
+    OrderedDict()
+_metadata_lock = threading.Lock()
+_metadata_fetches: 'singleflight.Group[Optional[RevisionMetadata]]' = \
+    singleflight.Group()
+
+
+def _metadata_key(project_id: ProjectId, revision_number: int) -> str:
+    return 'revisions/' + str(project_id) + '/' + str(revision_number) + \
+        '.meta.json'
+
+
+def _read_revision_metadata(project_id: ProjectId,
+                            revision_number: int) -> Optional[RevisionMetadata]:
+    try:
+        with metrics.dependency('s3_get_object'):
+            raw = revision_encoding.read_body(client.get_object(
+                Bucket=BUCKET_NAME,
+                Key=_metadata_key(project_id, revision_number)))
+        return RevisionMetadata.from_json(json.loads(raw))
+    except (botocore.exceptions.ClientError, ValueError, KeyError, TypeError,
+            zlib.error):
+        pass
+
+    # No sidecar yet, or a damaged one: revisions are uploaded straight to
+    # S3 by the client, so it is (re)written the first time someone asks.
+    revision = get_revision(project_id, revision_number)
+    if revision is None:
+        return None
+    metadata = RevisionMetadata(revision.title, revision.description)
+    try:
+        with metrics.dependency('s3_put_object'):
+            client.put_object(
+                Bucket=BUCKET_NAME,
+                Key=_metadata_key(project_id, revision_number),
+                Body=json.dumps(metadata.to_json()).encode('utf-8'),
+                ContentType='application/json')
+    except botocore.exceptions.ClientError:
+        pass
+    return metadata
+
+
+def get_revision_metadata(project_id: ProjectId,
+                          revision_number: int) -> Optional[RevisionMetadata]:
+    """The title and description of a revision, without downloading the
+    revision itself."""
+    key = (project_id, revision_number)
+    with _metadata_lock:
+        if key in _metadata_cache:
+            _metadata_cache.move_to_end(key)
+            return _metadata_cache[key]
+
+    metadata = _metadata_fetches.do(
+        key, lambda: _read_revision_metadata(project_id, revision_number))
+    if metadata is None:
+        return None
+
+    with _metadata_lock:
+        _metadata_cache[key] = metadata
+        while len(_metadata_cache) > MAX_CACHED_METADATA:
+            _metadata_cache.popitem(last=False)
+    return metadata
+
+
 def revision_exists(project_id: ProjectId, revision_number: int) -> bool:
     try:
         key = 'revisions/' + str(project_id) + '/' + str(
             revision_number) + '.json'
-        client.head_object(Bucket=BUCKET_NAME, Key=key)
+        with metrics.dependency('s3_head_object'):
+            client.head_object(Bucket=BUCKET_NAME, Key=key)
         return True
     except:
         return False
@@ -106,17 +267,17 @@ def revision_exists(project_id: ProjectId, revision_number: int) -> bool:
 
 def get_revision_upload_signature(project_id: ProjectId,
                                   revision_number: int) -> Any:
-    data = client.generate_presigned_post(
-        Bucket=BUCKET_NAME,
-        Key='revisions/' + str(project_id) + '/' + str(revision_number) +
-        '.json',
-        Fields={'acl': 'public-read',
-                'Content-Type': 'application/json'},
-        Conditions=[{
-            'acl': 'public-read'
-        }, {
-            'Content-Type': 'application/json'
-        }])
+    fields = {'acl': 'public-read', 'Content-Type': 'application/json'}
+    if GZIP_REVISION_UPLOADS:
+        fields['Content-Encoding'] = revision_encoding.GZIP
+
+    with metrics.dependency('s3_presign'):
+        data = client.generate_presigned_post(
+            Bucket=BUCKET_NAME,
+            Key='revisions/' + str(project_id) + '/' + str(revision_number) +
+            '.json',
+            Fields=fields,
+            Conditions=[{key: value} for key, value in fields.items()])
 
     data['projectId'] = str(project_id)
     data['revisionNumber'] = revision_number
@@ -125,94 +286,26 @@ def get_revision_upload_signature(project_id: ProjectId,
 
 def get_result_upload_signature(project_id: ProjectId,
                                 revision_number: int) -> Any:
-    data = client.generate_presigned_post(
-        Bucket=BUCKET_NAME,
-        Key='revisions/' + str(project_id) + '/' + str(revision_number) +
-        '.html',
-        Fields={'acl': 'public-read',
-                'Content-Type': 'text/html'},
-        Conditions=[{
-            'acl': 'public-read'
-        }, {
-            'Content-Type': 'text/html'
-        }])
+    with metrics.dependency('s3_presign'):
+        data = client.generate_presigned_post(
+            Bucket=BUCKET_NAME,
+            Key='revisions/' + str(project_id) + '/' + str(revision_number) +
+            '.html',
+            Fields={'acl': 'public-read',
+                    'Content-Type': 'text/html'},
+            Conditions=[{
+                'acl': 'public-read'
+            }, {
+                'Content-Type': 'text/html'
+            }])
 
     data['projectId'] = str(project_id)
     data['revisionNumber'] = revision_number
     return data
 
 
-all_versions = [
-    Version(0, 18, 0),
-    Version(0, 17, 1),
-    Version(0, 17, 0),
-    Version(0, 16, 0),
-    Version(0, 15, 0)
-]
-
-
-class SearchablePackages(NamedTuple):
-    latest_by_elm_version: Dict[Version, Package]
-    versions: List[Version]
-
-
-class PackagesCache(NamedTuple):
-    last_updated: datetime
-    data: Dict[PackageName, SearchablePackages]
-
-
-def organize_packages(
-        packages: List[PackageInfo]) -> Dict[PackageName, SearchablePackages]:
-    data: Dict[PackageName, SearchablePackages] = {}
-    for package in packages:
-        key = PackageName(package.username, package.package)
-        if key not in data:
-            data[key] = SearchablePackages({}, [])
-
-        data[key].versions.append(package.version)
-
-        for version in all_versions:
-            if package.elm_constraint is not None and package.elm_constraint.is_satisfied(
-                    version):
-                if version not in data[key].latest_by_elm_version:
-                    data[key].latest_by_elm_version[
-                        version] = package.to_package()
-                if data[key].latest_by_elm_version[version].version < package.version:
-                    data[key].latest_by_elm_version[
-                        version] = package.to_package()
-    return data
-
-
-def download_searchable_packages() -> Dict[PackageName, SearchablePackages]:
-    body = s3.Object(BUCKET_NAME,
-                     'package-artifacts/searchable.json').get()['Body']
-    data = body.read()
-    packages = list(
-        cat_optionals(PackageInfo.from_json(x) for x in json.loads(data)))
-    body.close()
-    return organize_packages(packages)
-
-
 def parse_int(string: str) -> Optional[int]:
     try:
         return int(string)
     except:
         return None
-
-
-cache_diff: timedelta = timedelta(minutes=15)
-
-packages_cache: PackagesCache = PackagesCache(datetime.utcnow(),
-                                              download_searchable_packages())
-
-
-def refresh_packages_cache() -> None:
-    global packages_cache
-    now = datetime.utcnow()
-    if now - packages_cache.last_updated > cache_diff:
-        packages_cache = PackagesCache(now, download_searchable_packages())
-
-
-def get_searchable_packages() -> Dict[PackageName, SearchablePackages]:
-    refresh_packages_cache()
-    return packages_cache.data
@@ -0,0 +1,122 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+BUCKET_NAME = os.environ['AWS_S3_BUCKET']
+LOCK_KEY = 'package-artifacts/sync.lock'
+LOCK_TTL_SECONDS = int(os.environ.get('PACKAGE_SYNC_LOCK_SECONDS', '900'))
+
+# How long to wait between writing the lock and reading it back. Two runners
+# racing for an expired lock both write it, and only the last write wins.
+SETTLE_SECONDS = 2.0
+
+client = boto3.client('s3')
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def _now_millis() -> int:
+    return int(time.time() * 1000)
+
+
+class SyncLock(object):
+    """A lease on the package sync, held in S3 so only one runner across the
+    cluster syncs at a time. While held, the lease is renewed in the
+    background so long syncs do not lose it.
+
+    S3 has no compare-and-swap, so writing, waiting SETTLE_SECONDS and
+    reading back narrows the race between two runners but cannot close it.
+    Runners therefore call `check` between steps, which raises LeaseLost
+    once renewal has found another owner, and `verify` before publishing,
+    which reads the lease again.
+    """
+
+    def __init__(self, ttl_seconds: int = LOCK_TTL_SECONDS) -> None:
+        self.owner = socket.gethostname() + ':' + str(os.getpid()) + ':' + \
+            uuid.uuid4().hex
+        self.ttl_seconds = ttl_seconds
+        self._stop = threading.Event()
+        self._lost = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        try:
+            body = client.get_object(Bucket=BUCKET_NAME, Key=LOCK_KEY)['Body']
+            data = json.loads(body.read())
+            body.close()
+            return data
+        except ClientError:
+            return None
+
+    def _write(self) -> None:
+        client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=LOCK_KEY,
+            Body=json.dumps({
+                'owner': self.owner,
+                'expires': _now_millis() + self.ttl_seconds * 1000
+            }).encode('utf-8'),
+            ContentType='application/json')
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.ttl_seconds / 3):
+            current = self._read()
+            if current is None or current.get('owner') != self.owner:
+                self._lost.set()
+                print('sync_lock: lost the sync lock to ' +
+                      str(current.get('owner') if current else None))
+                return
+            try:
+                self._write()
+            except ClientError as e:
+                self._lost.set()
+                print('sync_lock: could not renew the sync lock: ' + str(e))
+                return
+
+    def check(self) -> None:
+        if self._lost.is_set():
+            raise LeaseLost()
+
+    def verify(self) -> None:
+        self.check()
+        current = self._read()
+        if current is None or current.get('owner') != self.owner:
+            self._lost.set()
+            raise LeaseLost()
+
+    def acquire(self) -> bool:
+        current = self._read()
+        if current is not None and current.get('owner') != self.owner and \
+                current.get('expires', 0) > _now_millis():
+            return False
+
+        self._write()
+        time.sleep(SETTLE_SECONDS)
+        current = self._read()
+        if current is None or current.get('owner') != self.owner:
+            return False
+
+        self._stop.clear()
+        self._lost.clear()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def release(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+        current = self._read()
+        if current is not None and current.get('owner') == self.owner:
+            client.delete_object(Bucket=BUCKET_NAME, Key=LOCK_KEY)
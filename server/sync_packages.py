@@ -6,19 +6,22 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import traceback
 import zipfile
+from contextlib import contextmanager
 from datetime import datetime
-from typing import (Any, Dict, Iterator, List, NamedTuple, Optional, Set,
-                    SupportsInt, Tuple, TypeVar)
+from typing import (IO, Any, Dict, Iterator, List, NamedTuple, Optional,
+                    Set, SupportsInt, Tuple, TypeVar)
 
 import boto3
 import glob2
 import requests
 from joblib import Parallel, delayed
 
-from . import storage
-from .classes import Constraint, PackageInfo, Version
+from .classes import (Constraint, PackageInfo, PackageInfoTable, Version,
+                      intern_package_name)
+from .sync_lock import SyncLock
 
 BUCKET_NAME = os.environ['AWS_S3_BUCKET']
 
@@ -53,12 +56,14 @@ def download_packages() -> Any:
 def organize_packages(data: Any) -> List[PackageInfo]:
     output = []
     for entry in data:
-        username = entry['name'].split('/')[0]
-        package = entry['name'].split('/')[1]
+        split = entry['name'].split('/')
+        if len(split) != 2:
+            continue
+        name = intern_package_name(split[0], split[1])
         for version in entry['versions']:
             v = Version.from_string(version)
             if v is not None:
-                output.append(PackageInfo(username, package, v))
+                output.append(PackageInfo(name.user, name.project, v))
     return output
 
 
@@ -97,8 +102,13 @@ def read_package_json(base_dir: str, package: PackageInfo) -> Any:
     return json_data
 
 
-def read_source_files(base_dir: str, package: PackageInfo,
-                      package_json: Any) -> Any:
+# Source bundles are built in memory up to this size, then on disk.
+SOURCE_SPOOL_BYTES = 1024 * 1024
+SOURCE_CHUNK_CHARS = 64 * 1024
+
+
+def source_filenames(base_dir: str, package: PackageInfo,
+                     package_json: Any) -> List[str]:
     package_dir = os.path.join(base_dir,
                                package.package + '-' + str(package.version))
     nested_elm = [
@@ -109,13 +119,33 @@ def read_source_files(base_dir: str, package: PackageInfo,
         os.path.join(package_dir, a, '**/*.js')
         for a in package_json['source-directories']
     ]
+    return glob_all(nested_elm + nested_js)
 
-    filenames = glob_all(nested_elm + nested_js)
-    output = {}
-    for filename in filenames:
+
+def write_source_files(base_dir: str, package: PackageInfo,
+                       package_json: Any, out: IO[bytes]) -> None:
+    """Writes the same JSON object `json.dumps` would for a dict of relative
+    file name to contents, one chunk of one file at a time, so no more
+    than a chunk of source is held in memory."""
+    package_dir = os.path.join(base_dir,
+                               package.package + '-' + str(package.version))
+    out.write(b'{')
+    for i, filename in enumerate(
+            source_filenames(base_dir, package, package_json)):
+        if i > 0:
+            out.write(b', ')
+        key = filename.replace(package_dir + '/', '')
+        out.write(json.dumps(key).encode('ascii') + b': "')
         with open(filename, 'r') as file_data:
-            output[filename.replace(package_dir + '/', '')] = file_data.read()
-    return output
+            while True:
+                chunk = file_data.read(SOURCE_CHUNK_CHARS)
+                if not chunk:
+                    break
+                # Escaping works character by character, so encoding each
+                # chunk separately gives the same output as the whole file.
+                out.write(json.dumps(chunk)[1:-1].encode('ascii'))
+        out.write(b'"')
+    out.write(b'}')
 
 
 def read_artifacts(base_dir: str, package: PackageInfo) -> Any:
@@ -166,20 +196,44 @@ def needs_prebuild(package: PackageInfo) -> bool:
     return package.username == 'elm-lang' or (package.username == 'rtfeldman' and package.package == 'elm-css')
 
 
-def process_package(package: PackageInfo) -> Tuple[bool, PackageInfo]:
+@contextmanager
+def timed_stage(timings: Optional[Dict[str, float]],
+                stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + \
+                time.perf_counter() - started
+
+
+def dependency_entry(package_json: Any) -> Any:
+    return {
+        'elmVersion': package_json['elm-version'],
+        'dependencies': package_json['dependencies']
+    }
+
+
+def process_package(package: PackageInfo,
+                    timings: Optional[Dict[str, float]] = None
+                    ) -> Tuple[bool, PackageInfo, Any]:
     try:
         base_dir = make_temp_directory()
-        download_package_zip(base_dir, package)
-        unzip_and_delete(base_dir)
-        package_json = read_package_json(base_dir, package)
+        with timed_stage(timings, 'download'):
+            download_package_zip(base_dir, package)
+        with timed_stage(timings, 'unzip'):
+            unzip_and_delete(base_dir)
+        with timed_stage(timings, 'read_sources'):
+            package_json = read_package_json(base_dir, package)
         constraint = Constraint.from_string(package_json['elm-version'])
         if constraint is None:
             shutil.rmtree(base_dir)
-            return (False, package)
+            return (False, package, None)
 
         if not constraint.is_satisfied(min_required_version):
             shutil.rmtree(base_dir)
-            return (False, package)
+            return (False, package, None)
 
         package.set_elm_constraint(constraint)
 
@@ -191,42 +245,54 @@ def process_package(package: PackageInfo) -> Tuple[bool, PackageInfo]:
             package_dir = os.path.join(
                 base_dir, package.package + '-' + str(package.version))
 
-            process_output = subprocess.run(
-                [elm_path, '--yes'],
-                cwd=package_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
+            with timed_stage(timings, 'elm_make'):
+                process_output = subprocess.run(
+                    [elm_path, '--yes'],
+                    cwd=package_dir,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
 
             if process_output.returncode != 0:
                 stderr_as_str = process_output.stderr.decode('utf-8')
                 raise Exception(stderr_as_str)
 
-            artifacts = read_artifacts(base_dir, package)
-            bucket.put_object(
-                Key=package.s3_artifacts_key(Version(0, 18, 0)),
-                ACL='public-read',
-                Body=json.dumps(artifacts).encode('utf-8'),
-                ContentType='application/json')
-
-        source_files = read_source_files(base_dir, package, package_json)
-        bucket.put_object(
-            Key=package.s3_package_key(),
-            ACL='public-read',
-            Body=json.dumps(package_json).encode('utf-8'),
-            ContentType='application/json')
-        bucket.put_object(
-            Key=package.s3_source_key(),
-            ACL='public-read',
-            Body=json.dumps(source_files).encode('utf-8'),
-            ContentType='application/json')
+            with timed_stage(timings, 'read_sources'):
+                artifacts = read_artifacts(base_dir, package)
+            with timed_stage(timings, 'upload'):
+                bucket.put_object(
+                    Key=package.s3_artifacts_key(Version(0, 18, 0)),
+                    ACL='public-read',
+                    Body=json.dumps(artifacts).encode('utf-8'),
+                    ContentType='application/json')
+
+        with tempfile.SpooledTemporaryFile(
+                max_size=SOURCE_SPOOL_BYTES) as source_files:
+            with timed_stage(timings, 'read_sources'):
+                write_source_files(base_dir, package, package_json,
+                                   source_files)
+                source_files.seek(0)
+            with timed_stage(timings, 'upload'):
+                bucket.put_object(
+                    Key=package.s3_package_key(),
+                    ACL='public-read',
+                    Body=json.dumps(package_json).encode('utf-8'),
+                    ContentType='application/json')
+                # Switches to a multipart upload for large bundles.
+                bucket.upload_fileobj(
+                    source_files,
+                    package.s3_source_key(),
+                    ExtraArgs={
+                        'ACL': 'public-read',
+                        'ContentType': 'application/json'
+                    })
 
         shutil.rmtree(base_dir)
-        return (True, package)
+        return (True, package, dependency_entry(package_json))
     except:
         shutil.rmtree(base_dir)
         print(package)
         print(sys.exc_info())
-        return (False, package)
+        return (False, package, None)
 
 
 def upload_searchable_packages(packages: List[PackageInfo]) -> None:
@@ -237,6 +303,22 @@ def upload_searchable_packages(packages: List[PackageInfo]) -> None:
         ContentType='application/json')
 
 
+def upload_dependency_graph(graph: Dict[str, Dict[str, Any]]) -> None:
+    bucket.put_object(
+        Key='package-artifacts/dependencies.json',
+        ACL='public-read',
+        Body=json.dumps(graph, separators=(',', ':')).encode('utf-8'),
+        ContentType='application/json')
+
+
+def upload_last_updated(time: int) -> None:
+    bucket.put_object(
+        Key='package-artifacts/last-updated',
+        ACL='public-read',
+        Body=json.dumps(time).encode('utf-8'),
+        ContentType='application/json')
+
+
 def upload_failed_packages(packages: List[PackageInfo]) -> None:
     bucket.put_object(
         Key='package-artifacts/known_failures.json',
@@ -250,14 +332,54 @@ def download_searchable_packages() -> Set[PackageInfo]:
         body = s3.Object(BUCKET_NAME,
                          'package-artifacts/searchable.json').get()['Body']
         data = body.read()
-        packages = set(
-            cat_optionals(PackageInfo.from_json(x) for x in json.loads(data)))
+        packages = set(PackageInfoTable.from_json(json.loads(data)))
         body.close()
         return packages
     except:
         return set()
 
 
+def download_dependency_graph() -> Dict[str, Dict[str, Any]]:
+    try:
+        body = s3.Object(BUCKET_NAME,
+                         'package-artifacts/dependencies.json').get()['Body']
+        data = json.loads(body.read())
+        body.close()
+        return data
+    except:
+        return {}
+
+
+def download_package_json(package: PackageInfo) -> Any:
+    try:
+        body = s3.Object(BUCKET_NAME, package.s3_package_key()).get()['Body']
+        data = json.loads(body.read())
+        body.close()
+        return data
+    except:
+        return None
+
+
+def add_to_dependency_graph(graph: Dict[str, Dict[str, Any]],
+                            package: PackageInfo, entry: Any) -> None:
+    name = package.username + '/' + package.package
+    graph.setdefault(name, {})[str(package.version)] = entry
+
+
+def backfill_dependency_graph(graph: Dict[str, Dict[str, Any]],
+                              packages: Set[PackageInfo]) -> None:
+    # Packages synced before the graph existed only have their
+    # elm-package.json in S3, so read it back from there once.
+    for package in packages:
+        name = package.username + '/' + package.package
+        if str(package.version) in graph.get(name, {}):
+            continue
+        package_json = download_package_json(package)
+        if package_json is not None:
+            add_to_dependency_graph(graph, package,
+                                    dependency_entry(package_json))
+
+
 def download_known_failures() -> Set[PackageInfo]:
     try:
         body = s3.Object(BUCKET_NAME,
@@ -271,7 +393,10 @@ def download_known_failures() -> Set[PackageInfo]:
         return set()
 
 
-def run() -> None:
+def run(lock: Optional[SyncLock] = None) -> None:
+    """Runs one sync. With a lock, stops with LeaseLost as soon as the
+    lease is found to belong to someone else, and before uploading
+    anything if it no longer holds it."""
     data = download_packages()
     num_cores = multiprocessing.cpu_count()
 
@@ -280,6 +405,8 @@ def run() -> None:
     packages = organize_packages(data)
     searchable = download_searchable_packages()
     known_failures = download_known_failures()
+    graph = download_dependency_graph()
+    backfill_dependency_graph(graph, searchable)
     filtered_packages = [
         p for p in packages if p not in searchable and p not in known_failures]
     package_groups = [
@@ -290,19 +417,29 @@ def run() -> None:
     total = len(filtered_packages)
     failed = []
     for package_group in package_groups:
+        if lock is not None:
+            lock.check()
         results = Parallel(n_jobs=num_cores)(delayed(process_package)(i)
                                              for i in package_group)
         counter += num_cores
-        for (succeeded, package) in results:
+        for (succeeded, package, entry) in results:
             if succeeded:
                 searchable.add(package)
+                add_to_dependency_graph(graph, package, entry)
             else:
                 failed.append(package)
 
         print('sync_packages: ' + str((counter * 100) // total) + '%')
 
+    if lock is not None:
+        lock.verify()
+    # Uploaded before searchable.json, so a catalog built from a new
+    # snapshot never sees an older graph.
+    upload_dependency_graph(graph)
     upload_searchable_packages(list(searchable))
     upload_failed_packages(failed + list(known_failures))
+    # Web workers watch this marker to know a new snapshot is available.
+    upload_last_updated(get_current_time())
     print('sync_packages: finished')
 
 
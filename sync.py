@@ -1,3 +1,8 @@
-from server.sync_packages import run
+import sys
 
-run()
+from server import clock
+
+if '--schedule' in sys.argv:
+    clock.start()
+else:
+    clock.run_sync_packages()
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from typing import List, Tuple
+
+from server import classes
+from server.classes import ProjectId
+
+PROCESSES = 4
+IDS_PER_PROCESS = 5000
+WORKER_ID_MASK = (1 << classes.WORKER_ID_BITS) - 1
+
+
+def generate_many(count: int) -> Tuple[int, int, List[int]]:
+    ids = [int(ProjectId.generate()) for _ in range(count)]
+    return os.getpid(), ids[0] >> classes.SEQ_ID_BITS & WORKER_ID_MASK, ids
+
+
+class ProjectIdGeneratorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.slots_dir = tempfile.TemporaryDirectory()
+        self.previous_slots_dir = classes.WORKER_SLOTS_DIR
+        classes.WORKER_SLOTS_DIR = self.slots_dir.name
+
+    def tearDown(self) -> None:
+        classes.WORKER_SLOTS_DIR = self.previous_slots_dir
+        self.slots_dir.cleanup()
+
+    def test_live_processes_get_distinct_worker_ids(self) -> None:
+        with multiprocessing.Pool(PROCESSES) as pool:
+            results = pool.map(generate_many, [IDS_PER_PROCESS] * PROCESSES)
+
+        # A pool process may run more than one batch, so compare against
+        # the processes that actually ran.
+        worker_ids = {pid: worker_id for pid, worker_id, _ in results}
+        self.assertEqual(len(set(worker_ids.values())), len(worker_ids))
+        ids = [x for _, _, result in results for x in result]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_slots_are_not_shared_while_held(self) -> None:
+        first, first_file = classes._claim_slot(self.slots_dir.name)
+        second, second_file = classes._claim_slot(self.slots_dir.name)
+        self.assertNotEqual(first, second)
+
+        first_file.close()
+        third, third_file = classes._claim_slot(self.slots_dir.name)
+        self.assertEqual(third, first)
+        second_file.close()
+        third_file.close()
+
+    def test_dyno_number(self) -> None:
+        self.assertEqual(classes.dyno_number('web.3'), 3)
+        self.assertEqual(classes.dyno_number(''), 0)
+        with self.assertRaises(RuntimeError):
+            classes.dyno_number('web.' + str(1 << classes.DYNO_BITS))
+
+    def test_ids_round_trip(self) -> None:
+        project_id = ProjectId.generate()
+        self.assertEqual(ProjectId.from_string(str(project_id)), project_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
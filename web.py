@@ -1,4 +1 @@
-import server.clock
 from server.server import app
-
-server.clock.start()